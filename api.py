@@ -0,0 +1,293 @@
+"""
+JSON HTTP API for batch TTK queries.
+
+POST /api/analyze with a JSON body:
+
+    {
+        "weapons": [...],               # weapon data in the example.json schema
+        "spreads": [[0.5, 0.7], ...],   # (horizontal, vertical) spread per weapon in degrees,
+                                        # optional if every weapon has a "spread" entry
+        "aim_center": "chest",          # AIM_CENTER_DICT key or [x, y] offset in meters
+        "hp": 250,                      # target hp, number or list of numbers
+        "distances": {"min": 10, "max": 100, "num": 91},   # or an explicit list in meters
+        "ads": false,
+        "target": "cod1",               # hitbox model
+        "aim_error": [0.05, 0.05],      # optional aim jitter std in meters, number or (horizontal, vertical)
+        "sensitivity": false            # add d(DPS, TTK)/d(spread) metrics
+    }
+
+The response is NDJSON: a "meta" line with the distance and hp grids, one
+"weapon" line per weapon as soon as it is computed, and a final "done" line
+(or an "error" line). Every distance must be at or beyond each weapon's first
+dropoff, and non-finite values, e.g. the TTK of a beam that never hits, are
+written as null. Identical concurrent queries share one computation, and
+responses are gzip-compressed when the client accepts it.
+"""
+import json
+import threading
+import zlib
+
+import numpy as np
+from flask import Blueprint, Response, jsonify, request
+
+import hitboxes
+import utils
+from cache import make_key
+from results import METRICS, SENSITIVITY_METRICS
+
+
+MAX_API_WEAPONS = 200
+MAX_API_DISTANCES = 1000
+WEAPON_FIELDS = ('gun', 'fire_rate', 'ads', 'bullet_velocity', 'reload_time', 'mag_size', 'damage_profile')
+
+
+def parse_query(query):
+    """
+    Validate an analysis query and convert it into `utils.analyze` arguments
+
+    :param query: decoded JSON body
+    :return: dict of keyword arguments for `utils.analyze`
+    :raises ValueError: if the query is invalid
+    """
+    if not isinstance(query, dict):
+        raise ValueError("Request body must be a JSON object")
+    weapons = query.get('weapons')
+    if not isinstance(weapons, list) or not 0 < len(weapons) <= MAX_API_WEAPONS:
+        raise ValueError(f"'weapons' must be a list of 1 to {MAX_API_WEAPONS} weapons")
+    spreads = query.get('spreads')
+    if spreads is not None and len(spreads) != len(weapons):
+        raise ValueError("'spreads' must have one entry per weapon")
+    out_weapons = []
+    for i, wpn in enumerate(weapons):
+        missing = [k for k in WEAPON_FIELDS if k not in wpn]
+        if missing:
+            raise ValueError(f"Weapon {i} is missing {', '.join(missing)}")
+        wpn = dict(wpn)
+        spread = spreads[i] if spreads is not None else wpn.get('spread')
+        try:
+            spread = tuple(float(s) for s in spread)
+        except (TypeError, ValueError):
+            spread = ()
+        # Zero spread has no spread derivatives and non-finite values would end up as NaN in the response
+        if len(spread) != 2 or not all(np.isfinite(s) and s > 0 for s in spread):
+            raise ValueError(f"Weapon {i} needs a (horizontal, vertical) spread of positive degrees")
+        wpn['spread'] = spread
+        out_weapons.append(wpn)
+
+    aim_center = query.get('aim_center', 'chest')
+    if isinstance(aim_center, str):
+        if aim_center not in utils.AIM_CENTER_DICT:
+            raise ValueError(f"'aim_center' must be one of {list(utils.AIM_CENTER_DICT.keys())} or an offset")
+        center = utils.AIM_CENTER_DICT[aim_center]
+    else:
+        try:
+            center = (float(aim_center[0]), float(aim_center[1]))
+        except (TypeError, ValueError, IndexError, KeyError):
+            center = (np.nan, np.nan)
+        if not np.all(np.isfinite(center)):
+            raise ValueError("'aim_center' offset must be two finite numbers in meters")
+
+    distances = query.get('distances', {'min': 10, 'max': 100, 'num': 91})
+    distances_error = f"'distances' must hold 1 to {MAX_API_DISTANCES} positive values"
+    try:
+        if isinstance(distances, dict):
+            # Check the size before allocating the grid
+            num = distances['num']
+            if not isinstance(num, (int, float)) or num != int(num) or not 0 < num <= MAX_API_DISTANCES:
+                raise ValueError(distances_error)
+            distances = np.linspace(float(distances['min']), float(distances['max']), int(num))
+        elif not isinstance(distances, list) or not 0 < len(distances) <= MAX_API_DISTANCES:
+            raise ValueError(distances_error)
+        distances = np.asarray(distances, dtype=float)
+    except (TypeError, ValueError, KeyError, OverflowError):
+        raise ValueError(distances_error)
+    if distances.ndim != 1 or not np.all(np.isfinite(distances)) or np.any(distances <= 0):
+        raise ValueError(distances_error)
+
+    hp = query.get('hp', utils.DEFAULT_TARGET_HP)
+    try:
+        hp_values = np.asarray(hp, dtype=float)
+    except (TypeError, ValueError):
+        hp_values = np.array(np.nan)
+    if hp_values.ndim > 1 or hp_values.size == 0 or not np.all(np.isfinite(hp_values)) or np.any(hp_values <= 0):
+        raise ValueError("'hp' must be a positive number or a list of positive numbers")
+
+    target = query.get('target', hitboxes.DEFAULT_HITBOX)
+    if target not in hitboxes.HITBOXES:
+        raise ValueError(f"'target' must be one of {list(hitboxes.HITBOXES.keys())}")
+
+    try:
+        aim_error = utils.get_aim_error(query.get('aim_error'))
+    except (TypeError, ValueError):
+        raise ValueError("'aim_error' must be a non-negative number or a (horizontal, vertical) pair in meters")
+
+    for i, wpn in enumerate(out_weapons):
+        try:
+            first_dropoff = min(float(segment['dropoff']) for segment in wpn['damage_profile'])
+        except (TypeError, ValueError, KeyError):
+            raise ValueError(f"Weapon {i} needs a damage profile of segments with a 'dropoff' distance")
+        if distances.min() < first_dropoff:
+            raise ValueError(f"Weapon {i} has no damage values below its first dropoff at {first_dropoff:g} m")
+    # Catch aim centers off the hitbox here rather than as an error line in the stream
+    utils.setup_beam_model(center, target=target, aim_error=aim_error)
+
+    return dict(
+        weapons=out_weapons,
+        distances=distances,
+        center=center,
+        ads=bool(query.get('ads', False)),
+        target=target,
+        hp=hp,
+        sensitivity=bool(query.get('sensitivity', False)),
+        aim_error=aim_error,
+    )
+
+
+def to_json_values(values):
+    """
+    Array as nested lists with null in place of non-finite values, which JSON cannot represent
+    """
+    values = np.asarray(values)
+    out = values.astype(object)
+    out[~np.isfinite(values)] = None
+    return out.tolist()
+
+
+def iter_lines(kwargs, cache=None):
+    """
+    Run an analysis query and yield NDJSON lines, one weapon at a time
+
+    :param kwargs: arguments from `parse_query`
+    :param cache: optional per-weapon results cache
+    :return: generator of str
+    """
+    squeeze = np.ndim(kwargs['hp']) == 0
+    metrics = METRICS + SENSITIVITY_METRICS if kwargs['sensitivity'] else METRICS
+    yield json.dumps(dict(
+        type='meta',
+        metrics=metrics,
+        distances=kwargs['distances'].tolist(),
+        hp=np.atleast_1d(kwargs['hp']).tolist(),
+    )) + '\n'
+    num_distances = len(kwargs['distances'])
+    for results, i, num_done in utils.iter_analyze(
+            kwargs['weapons'], kwargs['distances'], kwargs['center'], ads=kwargs['ads'], target=kwargs['target'],
+            hp=kwargs['hp'], cache=cache, sensitivity=kwargs['sensitivity'], aim_error=kwargs['aim_error']):
+        if num_done < num_distances:
+            continue
+        line = dict(type='weapon', index=i, gun=results.guns[i])
+        for name in metrics:
+            values = results.metric(name)[i]
+            line[name] = to_json_values(values[:, 0] if squeeze else values)
+        yield json.dumps(line) + '\n'
+    yield json.dumps(dict(type='done')) + '\n'
+
+
+class _Flight:
+    """Lines of one in-flight computation, readable by any number of requests"""
+
+    def __init__(self):
+        self.lines = []
+        self.done = False
+        self.cond = threading.Condition()
+
+    def run(self, lines, on_finish):
+        try:
+            for line in lines:
+                with self.cond:
+                    self.lines.append(line)
+                    self.cond.notify_all()
+        except Exception as e:
+            with self.cond:
+                self.lines.append(json.dumps(dict(type='error', error=str(e))) + '\n')
+        finally:
+            on_finish()
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def __iter__(self):
+        i = 0
+        while True:
+            with self.cond:
+                while i >= len(self.lines) and not self.done:
+                    self.cond.wait()
+                chunk = self.lines[i:]
+                i = len(self.lines)
+                if not chunk and self.done:
+                    return
+            yield from chunk
+
+
+class Coalescer:
+    """
+    Share one computation between identical concurrent requests
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def stream(self, key, make_lines):
+        """
+        :param key: request content hash
+        :param make_lines: callable returning the line generator, only called by the first request
+        :return: iterator over the lines of the shared computation
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                thread = threading.Thread(
+                    target=flight.run,
+                    args=(make_lines(), lambda: self._finish(key, flight)),
+                    daemon=True,
+                )
+                thread.start()
+        return iter(flight)
+
+    def _finish(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+
+def gzip_lines(lines):
+    """
+    Gzip a stream of lines, flushing after each one so clients can decode them as they arrive
+    """
+    compressor = zlib.compressobj(wbits=31)
+    for line in lines:
+        yield compressor.compress(line.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def create_api(cache=None):
+    """
+    Build the API blueprint
+
+    :param cache: optional per-weapon results cache shared with the app
+    :return: flask.Blueprint
+    """
+    api = Blueprint('api', __name__, url_prefix='/api')
+    coalescer = Coalescer()
+
+    @api.route('/analyze', methods=['POST'])
+    def analyze():
+        try:
+            kwargs = parse_query(request.get_json(force=True, silent=True))
+        except (ValueError, TypeError, KeyError) as e:
+            return jsonify(error=str(e)), 400
+        key = make_key(
+            kwargs['weapons'],
+            kwargs['distances'], kwargs['center'], kwargs['ads'], kwargs['target'], kwargs['hp'],
+            kwargs['sensitivity'], kwargs['aim_error'],
+        )
+        lines = coalescer.stream(key, lambda: iter_lines(kwargs, cache=cache))
+        headers = {'X-Accel-Buffering': 'no', 'Vary': 'Accept-Encoding'}
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            headers['Content-Encoding'] = 'gzip'
+            lines = gzip_lines(lines)
+        return Response(lines, mimetype='application/x-ndjson', headers=headers)
+
+    return api
@@ -1,15 +1,26 @@
 from io import BytesIO
 import base64
 import json
+import uuid
+from urllib.parse import parse_qs
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, MATCH, ALL
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 
 import utils
+import hitboxes
+import api
+import duel
+import permalink
+import catalog
+from cache import LRUCache, make_key
+from scheduler import LatestWinsScheduler, AnalysisCancelled
+from results import AnalysisResults
 from truegamedata import get_weapons_data
 
 
@@ -20,20 +31,57 @@ APP_TITLE = "COD Warzone Recoil-Adjusted Damage Simulator"
 
 # Default parameters
 
-MAX_WEAPONS = 5                             # Sets the number of rows of recoil measurement inputs
+MAX_WEAPONS = 30                            # Max loadout size; each weapon gets its own row of recoil inputs
+DEFAULT_SPREAD = 1.0                        # Initial recoil spread in degrees
 DEFAULT_NUM_DISTANCES = 100                 # Number of distances at which to compute TTK/STK
 DEFAULT_MAX_DISTANCE = 100                  # Max analysis distance in meters
 DEFAULT_TARGET_DISTANCE = 50
+TARGET_DISTANCES = list(range(50, 151, 10))  # Target distance slider stops, one flipbook frame each
 DEFAULT_ZOOM = 4
+DEFAULT_AIM_ERROR = 0                       # Aim jitter standard deviation in centimeters
 DEFAULT_FOV = 80
 
 # Offset from image center in meters (horizontal, vertical)
-AIM_CENTER_DICT = {
-    'stomach': (0.07, 0.07),
-    # 'stomach/chest': (0.03, 0.28),
-    'chest': (0.0, 0.45),
-    'head': (-0.07, 0.72),
+AIM_CENTER_DICT = utils.AIM_CENTER_DICT
+
+# Target hp levels (100 base health plus 50 per armor plate), all computed in one analysis
+HP_LEVELS_DICT = {
+    'No armor': 100.0,
+    '1 plate': 150.0,
+    '2 plates': 200.0,
+    'Full armor': 250.0,
 }
+HP_LEVELS = list(HP_LEVELS_DICT.values())
+
+
+# Per-weapon analysis results, so replots only recompute weapons whose inputs changed
+RESULTS_CACHE = LRUCache(max_items=512)
+
+
+# Plots are computed in the background and drawn as each weapon comes in: the plot callback returns
+# once the first curve is ready (or after FIRST_CURVE_TIMEOUT seconds), then the page polls for the rest
+PLOT_POLL_INTERVAL = 300                    # milliseconds
+FIRST_CURVE_TIMEOUT = 10.
+
+
+# Local weapon catalog for building loadouts without TrueGameData requests; fetched weapons are added to it
+CATALOG = catalog.WeaponCatalog()
+
+
+# Computed results and figures of shared permalinks, keyed by the content hash of the linked state
+PERMALINK_STORE = permalink.create_store()
+
+# Short permalink ids and the tokens they stand for
+PERMALINK_LINKS = permalink.LinkStore()
+
+
+# Bullet distribution sprite sheets, keyed by everything in the image except the target distance,
+# which the browser scrubs through by switching frames
+FLIPBOOK_CACHE = LRUCache(max_items=64)
+
+
+# Debounced, latest-wins scheduling of live plot and image updates per browser session
+SCHEDULER = LatestWinsScheduler()
 
 
 # Pre-saved data for testing so we don't have to scrape TGD every time
@@ -54,15 +102,13 @@ with open('markdown/howto.md', 'r') as f:
 
 
 def fig_to_uri(in_fig):
-    # type: (plt.Figure) -> str
+    # type: (Figure) -> str
     """
     Save a figure as a URI, copied from
     https://github.com/plotly/dash-sample-apps/blob/master/apps/dash-nlp/wordcloud_matplotlib.py
     """
     out_img = BytesIO()
-    in_fig.savefig(out_img, format='png')
-    in_fig.clf()
-    plt.close('all')
+    in_fig.savefig(out_img, format='png', facecolor=in_fig.get_facecolor())
     out_img.seek(0)  # rewind file
     encoded = base64.b64encode(out_img.read()).decode("ascii").replace("\n", "")
     return "data:image/png;base64,{}".format(encoded)
@@ -78,50 +124,67 @@ def get_button_pressed():
     button_id = 'No clicks yet'
     if ctx.triggered:
         if ctx.triggered[0]['value'] is not None:
-            button_id = ctx.triggered[0]['prop_id'].split('.')[0]
+            button_id = ctx.triggered[0]['prop_id'].rsplit('.', 1)[0]
+            if button_id.startswith('{'):
+                button_id = json.loads(button_id)['type']    # pattern-matching id, e.g. one weapon's spread store
     return button_id
 
 
-def add_spreads(data, *spreads):
+def get_triggered():
     """
-    Update data variable with recoil spreads and return spreads as strings for HTML outputs
+    Return ids of all properties that triggered the current callback
+
+    :return: list of str "id.property"
+    """
+    return [t['prop_id'] for t in dash.callback_context.triggered]
+
+
+def add_spreads(data, spreads):
+    """
+    Update data variable with recoil spreads
 
     :param data: TGD data
-    :param spreads: list of recoil spreads [x1, y1, x2, y2, ...]
-    :return: list of strings with degree symbol ["x1°", "y1°", ...]
+    :param spreads: list of (horizontal, vertical) recoil spreads, one per weapon
+    :return: data
     """
-    for i, wpn in enumerate(data):
-        spread_x, spread_y = spreads[i * 2: i * 2 + 2]
+    for wpn, (spread_x, spread_y) in zip(data, spreads):
         wpn['spread'] = (float(spread_x), float(spread_y))
-    return data, [f"{s:.2f}°" for s in spreads]
+    return data
 
 
-def make_slider_col(text, min, max, step, value, mark_values, mark_fmt, width):
+def format_spread(spread):
+    return f"{spread:.2f}°"
+
+
+def make_slider_col(text, min, max, step, value, mark_values, mark_fmt, width, updatemode='mouseup'):
     marks = {v: mark_fmt.format(v) for v in mark_values}
-    slider = dcc.Slider(id=text, min=min, max=max, step=step, value=value, marks=marks)
+    slider = dcc.Slider(id=text, min=min, max=max, step=step, value=value, marks=marks, updatemode=updatemode)
     div = html.Div([slider], style={'height': '50px'})
     col = dbc.Col(div, width=width)
     return col
 
 
-def make_recoil_slider_col(dim, num, width):
+def make_recoil_slider_col(dim, num, width, value=DEFAULT_SPREAD, updatemode='mouseup'):
     """
     Generate a Slider for recoil measurements in a Dash Bootstrap column
 
-    :param dim:
-    :param num:
+    :param dim: 'x' or 'y'
+    :param num: weapon index
     :param width:
+    :param value: spread in degrees
+    :param updatemode: 'mouseup' or 'drag'
     :return:
     """
     col = make_slider_col(
-        text=f"spread-{dim}-input-{num}",
+        text={'type': f'spread-{dim}-input', 'index': num},
         min=0.05,
         max=2.51,
         step=0.05,
-        value=1.0,
+        value=value,
         mark_values=[0.05, 1, 2],
         mark_fmt="{:.2f}°",
-        width=width
+        width=width,
+        updatemode=updatemode,
     )
     return col
 
@@ -146,6 +209,26 @@ def make_distance_slider_col(width):
     return col
 
 
+def make_aim_error_slider_col(width):
+    """
+    Generate a Slider for aim error in a Dash Bootstrap column
+
+    :param width:
+    :return:
+    """
+    col = make_slider_col(
+        text='aim-error-input',
+        min=0,
+        max=30,
+        step=1,
+        value=DEFAULT_AIM_ERROR,
+        mark_values=[0, 10, 20, 30],
+        mark_fmt="{:.0f}cm",
+        width=width
+    )
+    return col
+
+
 def make_target_distance_slider_col(width):
     """
     Generate a Slider for hit box target distance in a Dash Bootstrap column
@@ -155,11 +238,32 @@ def make_target_distance_slider_col(width):
     """
     col = make_slider_col(
         text='target-distance-input',
-        min=50,
+        min=TARGET_DISTANCES[0],
+        max=TARGET_DISTANCES[-1],
+        step=TARGET_DISTANCES[1] - TARGET_DISTANCES[0],
+        value=DEFAULT_TARGET_DISTANCE,
+        mark_values=[50, 100, 150],
+        mark_fmt="{:.0f}m",
+        width=width,
+        updatemode='drag',
+    )
+    return col
+
+
+def make_duel_distance_slider_col(width):
+    """
+    Generate a Slider for head-to-head duel distance in a Dash Bootstrap column
+
+    :param width:
+    :return:
+    """
+    col = make_slider_col(
+        text='duel-distance-input',
+        min=10,
         max=150,
         step=10,
         value=DEFAULT_TARGET_DISTANCE,
-        mark_values=[50, 100, 150],
+        mark_values=[10, 50, 100, 150],
         mark_fmt="{:.0f}m",
         width=width
     )
@@ -206,67 +310,55 @@ def make_fov_slider_col(width):
     return col
 
 
-def make_recoil_divs(rows):
+def make_recoil_rows(guns, spreads, updatemode='mouseup'):
     """
-    Generate rows of recoil slider columns
+    Generate one row of recoil slider columns per weapon, with a store holding that weapon's spread
 
-    :param rows:
-    :return:
+    :param guns: weapon names
+    :param spreads: list of (horizontal, vertical) spreads, one per weapon
+    :param updatemode: slider update mode
+    :return: list of rows
     """
     out = []
-    for i in range(rows):
+    for i, (gun, (spread_x, spread_y)) in enumerate(zip(guns, spreads)):
         row = dbc.Row([
-            make_recoil_slider_col('x', i, width=5),
-            dbc.Col(html.Div(["1.00°"], id=f"spread-x-div-{i}"), width=1),
-            make_recoil_slider_col('y', i, width=5),
-            dbc.Col(html.Div(["1.00°"], id=f"spread-y-div-{i}"), width=1),
-        ], no_gutters=True)
-        out.append(row)
-    return out
-
-
-def make_weapon_name_divs(rows):
-    """
-    Generate rows of weapon name divs
-
-    :param rows:
-    :return:
-    """
-    out = []
-    for i in range(rows):
-        row = html.Div(id=f"weapon-name-{i}", style={'height': '50px'})
+            dbc.Col(html.Div(gun, style={'height': '50px'}), width=2, style={'textAlign': 'center'}),
+            dbc.Col(dbc.Row([
+                make_recoil_slider_col('x', i, width=5, value=spread_x, updatemode=updatemode),
+                dbc.Col(html.Div(format_spread(spread_x), id={'type': 'spread-x-div', 'index': i}), width=1),
+                make_recoil_slider_col('y', i, width=5, value=spread_y, updatemode=updatemode),
+                dbc.Col(html.Div(format_spread(spread_y), id={'type': 'spread-y-div', 'index': i}), width=1),
+            ], no_gutters=True), width=10),
+            dcc.Store(id={'type': 'spread-store', 'index': i}, data=[spread_x, spread_y]),
+        ])
         out.append(row)
     return out
 
 
-def make_recoil_card(max_weapons=MAX_WEAPONS):
+def make_recoil_card():
     header = "Step 2: Recoil spread (degrees)"
-    body = dbc.Row([
-        dbc.Col(
-            html.Div(
-                [
-                    dbc.Button(
-                        "Show help",
-                        id='howto-button',
-                        size='sm',
-                        style={'margin-bottom': 20, 'display': 'inline-block'}
-                    )
-                ] + make_weapon_name_divs(max_weapons)
+    body = html.Div([
+        dbc.Row([
+            dbc.Col(
+                dbc.Button(
+                    "Show help",
+                    id='howto-button',
+                    size='sm',
+                    style={'display': 'inline-block'}
+                ),
+                width=2, style={'textAlign': 'center'}
             ),
-            width=2, style={'textAlign': 'center'}
-        ),
-        dbc.Col(
-            html.Div(
-                [
-                    dbc.Row([
-                        dbc.Col(["Horizontal"], width=5),
-                        dbc.Col([], width=1),
-                        dbc.Col(["Vertical"], width=5),
-                        dbc.Col([], width=1),
-                    ], style={'margin-bottom': 25, 'textAlign': 'center'})
-                ] + make_recoil_divs(max_weapons)
-            ), width=10
-        ),
+            dbc.Col(
+                dbc.Row([
+                    dbc.Col(["Horizontal"], width=5),
+                    dbc.Col([], width=1),
+                    dbc.Col(["Vertical"], width=5),
+                    dbc.Col([], width=1),
+                ], style={'textAlign': 'center'}),
+                width=10
+            ),
+        ], style={'margin-bottom': 25}),
+        html.Div(id='recoil-rows'),
     ])
     card = dbc.Card([
         dbc.CardHeader(header),
@@ -288,6 +380,16 @@ def make_params_card():
                 style={'margin-left': 20, 'margin-bottom': 10, 'display': 'inline-block', 'textAlign': 'center'},
             )
         ], style={'width': '90%'}),
+        html.Div([
+            html.Center("Target model"),
+            dbc.RadioItems(
+                id='radio-target',
+                options=[{'label': v['label'], 'value': k} for k, v in hitboxes.HITBOXES.items()],
+                value=hitboxes.DEFAULT_HITBOX,
+                inline=True,
+                style={'margin-left': 20, 'margin-bottom': 10, 'display': 'inline-block', 'textAlign': 'center'},
+            )
+        ], style={'width': '90%'}),
         html.Div([
             html.Center("Max distance (meters)"),
             dbc.Row([
@@ -295,6 +397,13 @@ def make_params_card():
                 dbc.Col(html.Div(id=f"distance-div"), width=3)
             ])
         ]),
+        html.Div([
+            html.Center("Aim error (centimeters)"),
+            dbc.Row([
+                make_aim_error_slider_col(width=9),
+                dbc.Col(html.Div(id='aim-error-div'), width=3)
+            ])
+        ]),
         html.Div([
             html.Div("Add ADS to TTK:", style={'display': 'inline-block'}),
             dbc.RadioItems(
@@ -306,6 +415,16 @@ def make_params_card():
                 style={'margin-left': 20, 'display': 'inline-block'},
             )
         ]),
+        html.Div([
+            html.Div("Target HP:", style={'display': 'inline-block'}),
+            dbc.Checklist(
+                id='checklist-hp',
+                options=[{'label': f"{k} ({v:.0f})", 'value': v} for k, v in HP_LEVELS_DICT.items()],
+                value=[utils.DEFAULT_TARGET_HP],
+                inline=True,
+                style={'margin-left': 20, 'display': 'inline-block'},
+            )
+        ], style={'margin-top': 5}),
         html.Div([
             html.Div("Plot mode:", style={'display': 'inline-block'}),
             dbc.RadioItems(
@@ -318,9 +437,24 @@ def make_params_card():
                 style={'margin-left': 20, 'display': 'inline-block'},
             )
         ], style={'margin-top': 5}),
+        html.Div([
+            html.Div("Live update:", style={'display': 'inline-block'}),
+            dbc.RadioItems(
+                id='radio-live',
+                options=[{'label': 'On', 'value': 'on'},
+                         {'label': 'Off', 'value': 'off'}],
+                value='off',
+                inline=True,
+                style={'margin-left': 20, 'display': 'inline-block'},
+            )
+        ], style={'margin-top': 5}),
         html.Br(),
         dbc.Button('Generate performance plot', id='plot-button', block=True),
         html.Div("", id='perf-plot-err', style={'color': 'red', 'textAlign': 'center', 'margin-top': 5}),
+        dbc.Button('Create permalink', id='permalink-button', size='sm', block=True),
+        dcc.Input(id='permalink-output', type='text', value="", readOnly=True, placeholder="Share link",
+                  style={'width': '100%', 'margin-top': 5}),
+        html.A("", id='permalink-fallback', href="", style={'font-size': 'small'}),
     ])
     card = dbc.Card([
         dbc.CardHeader(header),
@@ -333,9 +467,10 @@ def make_params_card():
 
 app = dash.Dash(__name__, title=APP_TITLE, external_stylesheets=[dbc.themes.SLATE, 'assets/stylesheet.css'])
 server = app.server
+server.register_blueprint(api.create_api(cache=RESULTS_CACHE))
 
 
-app.layout = html.Div(
+LAYOUT = html.Div(
     html.Div([
 
 
@@ -387,6 +522,18 @@ app.layout = html.Div(
                                style={'margin-right': '10px', 'display': 'inline-block'}),
                     dbc.Button('Show help', id='fetch-help-button', size='sm',
                                style={'display': 'inline-block'}),
+                    html.Div([
+                        html.P("Or pick weapons from the local catalog:",
+                               style={'margin-right': '10px', 'display': 'inline-block'}),
+                        html.Div(
+                            dcc.Dropdown(id='catalog-dropdown', multi=True, placeholder="Type a weapon name",
+                                         style={'color': 'black'}),
+                            style={'width': '500px', 'margin-right': '10px', 'display': 'inline-block',
+                                   'vertical-align': 'middle'},
+                        ),
+                        dbc.Button('Use catalog weapons', id='catalog-button', size='sm',
+                                   style={'display': 'inline-block'}),
+                    ], style={'margin-top': 10}),
                     dbc.Collapse(
                         dcc.Markdown(FETCH_TEXT),
                         id='fetch-help-collapse',
@@ -397,6 +544,8 @@ app.layout = html.Div(
             ]),
         ]),
         dcc.Store(id='weapons-data-store'),
+        dcc.Location(id='url', refresh=False),
+        dcc.Store(id='permalink-store'),
         html.Br(),
 
 
@@ -424,6 +573,9 @@ app.layout = html.Div(
         # PERFORMANCE PLOT SECTION
         dcc.Store(data='ttk', id='perf-plot-store'),
         dcc.Store(id='results-store'),
+        dcc.Store(id='plot-request-store'),
+        dcc.Store(id='plot-job-store'),
+        dcc.Interval(id='plot-interval', interval=PLOT_POLL_INTERVAL, disabled=True),
         dbc.Card([
             dbc.CardHeader("Simulated performance plot (Time-to-kill)", id='perf-plot-header'),
             dbc.CardBody([
@@ -460,7 +612,16 @@ app.layout = html.Div(
                                 inline=True,
                             ),
                         ], width=2),
-                        dbc.Col([], width=2),
+                        dbc.Col([
+                            html.Div("Spread sensitivity: ", style={'display': 'inline-block'}),
+                            dbc.RadioItems(
+                                id='radio-show-sens',
+                                options=[{'label': 'Hide', 'value': 'hide'},
+                                         {'label': 'Show', 'value': 'show'}],
+                                value='hide',
+                                inline=True,
+                            ),
+                        ], width=2),
                     ]),
                     html.Br(),
                     html.Center(
@@ -478,6 +639,23 @@ app.layout = html.Div(
         html.Br(),
 
 
+        # HEAD-TO-HEAD SECTION
+        dbc.Card([
+            dbc.CardHeader("Head-to-head duels"),
+            dbc.CardBody([
+                html.Div([
+                    html.Center("Duel distance (meters)"),
+                    dbc.Row([
+                        make_duel_distance_slider_col(width=9),
+                        dbc.Col(html.Div(id='duel-distance-div'), width=3)
+                    ]),
+                ], style={'width': '50%', 'margin': '0 auto'}),
+                html.Center(dcc.Graph(id='duel-figure')),
+            ]),
+        ]),
+        html.Br(),
+
+
         # RECOIL SPREAD IMAGE SECTION
         dbc.Card([
             dbc.CardHeader("Bullet distribution"),
@@ -523,9 +701,9 @@ app.layout = html.Div(
                         ]), width=2,
                     ),
                 ], style={'width': '90%', 'margin': '0 auto'}),
-                html.Div([
-                    html.Img(id='target-img', src='', style={'max-width': '80%'})
-                ], style={'textAlign': 'center'})
+                dcc.Store(id='selected-weapon-store'),
+                dcc.Store(id='target-flipbook-store'),
+                html.Div(id='target-img', style={'display': 'none'}),
             ]),
         ])
     ], style={'width': 1200, 'margin': '0 auto'}),
@@ -533,19 +711,19 @@ app.layout = html.Div(
 )
 
 
-# Organize outputs, inputs, and states for weapons and recoil measurements
-weapon_name_outputs = []
-spread_inputs = []
-spread_states = []
-spread_outputs = []
-for n in range(MAX_WEAPONS):
-    weapon_name_outputs.append(Output(f'weapon-name-{n}', 'children'))
-    spread_inputs.append(Input(f'spread-x-input-{n}', 'value'))
-    spread_inputs.append(Input(f'spread-y-input-{n}', 'value'))
-    spread_states.append(State(f'spread-x-input-{n}', 'value'))
-    spread_states.append(State(f'spread-y-input-{n}', 'value'))
-    spread_outputs.append(Output(f'spread-x-div-{n}', 'children'))
-    spread_outputs.append(Output(f'spread-y-div-{n}', 'children'))
+def serve_layout():
+    """
+    Build the page layout; each page load gets its own session id for request scheduling
+    """
+    return html.Div([dcc.Store(id='session-id', data=str(uuid.uuid4())), LAYOUT])
+
+
+app.layout = serve_layout
+
+
+# Every weapon's recoil spread, from the per-weapon stores
+spread_input = Input({'type': 'spread-store', 'index': ALL}, 'data')
+spread_state = State({'type': 'spread-store', 'index': ALL}, 'data')
 
 
 @app.callback(
@@ -557,11 +735,19 @@ def update_distance_div(distance):
 
 
 @app.callback(
-    Output('target-distance-div', 'children'),
-    Input('target-distance-input', 'value')
+    Output('aim-error-div', 'children'),
+    Input('aim-error-input', 'value')
 )
-def update_target_distance_div(target_distance):
-    return f"{target_distance} m"
+def update_aim_error_div(aim_error):
+    return f"{aim_error} cm"
+
+
+@app.callback(
+    Output('duel-distance-div', 'children'),
+    Input('duel-distance-input', 'value')
+)
+def update_duel_distance_div(duel_distance):
+    return f"{duel_distance} m"
 
 
 @app.callback(
@@ -580,6 +766,35 @@ def update_fov_div(fov):
     return f"{fov}°"
 
 
+@app.callback(
+    [Output({'type': 'spread-x-input', 'index': ALL}, 'updatemode'),
+     Output({'type': 'spread-y-input', 'index': ALL}, 'updatemode')],
+    [Input('radio-live', 'value')],
+    [spread_state]
+)
+def update_slider_mode(live, spreads):
+    """
+    Send recoil slider values while dragging in live mode, only on release otherwise
+    """
+    mode = 'drag' if live == 'on' else 'mouseup'
+    return [mode for _ in spreads], [mode for _ in spreads]
+
+
+@app.callback(
+    [Output({'type': 'spread-x-div', 'index': MATCH}, 'children'),
+     Output({'type': 'spread-y-div', 'index': MATCH}, 'children'),
+     Output({'type': 'spread-store', 'index': MATCH}, 'data')],
+    [Input({'type': 'spread-x-input', 'index': MATCH}, 'value'),
+     Input({'type': 'spread-y-input', 'index': MATCH}, 'value')],
+    prevent_initial_call=True
+)
+def update_spread(spread_x, spread_y):
+    """
+    Update the labels and store of the one weapon whose slider moved
+    """
+    return format_spread(spread_x), format_spread(spread_y), [spread_x, spread_y]
+
+
 @app.callback(
     Output('about-modal', 'is_open'),
     [Input('about-button', 'n_clicks'), Input('about-close', 'n_clicks')],
@@ -606,54 +821,205 @@ def toggle_howto_modal(n1, n2, is_open):
     [Output('weapons-data-store', 'data'),
      Output('weapons-data', 'children'),
      Output('wpn-dropdown', 'options'),
-     Output('wpn-dropdown', 'value')] + weapon_name_outputs + spread_outputs,
+     Output('wpn-dropdown', 'value'),
+     Output('recoil-rows', 'children')],
     [Input('fetch-button', 'n_clicks'),
-     Input('example-button', 'n_clicks')] + spread_inputs,
-    [State('link-input', 'value'), State('weapons-data-store', 'data')]
+     Input('example-button', 'n_clicks'),
+     Input('catalog-button', 'n_clicks'),
+     Input('permalink-store', 'data')],
+    [State('link-input', 'value'),
+     State('catalog-dropdown', 'value'),
+     State('radio-live', 'value'),
+     spread_state]
 )
-def update_data(btn1, btn2, *args):
-    spreads = args[:-2]
-    link, data = args[-2:]
-    if data is not None:
-        data, spread_labels = add_spreads(data, *spreads)
-    else:
-        data, spread_labels = add_spreads([], *spreads)
+def update_data(btn1, btn2, btn3, linked, link, catalog_ids, live, spreads):
+    """
+    Load a loadout and build one row of recoil inputs per weapon. Spreads of existing rows are kept,
+    and moving a slider only runs `update_spread` for its own row.
+    """
     button_id = get_button_pressed()
     fetch = (button_id == 'fetch-button')
     example = (button_id == 'example-button')
-
-    if fetch:
-        if 'share=' in link:
-            data = get_weapons_data(link)
-            data, spread_labels = add_spreads(data, *spreads)
-            weapons, output_str = get_weapon_text(data)
-        else:
-            weapons = ["N/A" for _ in range(MAX_WEAPONS)]
-            output_str = "Invalid link."
+    from_catalog = (button_id == 'catalog-button')
+    restore = 'permalink-store.data' in get_triggered() and linked is not None and 'state' in linked
+
+    if restore:
+        data = linked['state']['weapons']
+        spreads = [wpn['spread'] for wpn in data]
+    elif fetch:
+        if 'share=' not in link:
+            return dash.no_update, "Invalid link.", dash.no_update, dash.no_update, dash.no_update
+        data = get_weapons_data(link)
+        CATALOG.import_weapons(data)
+    elif from_catalog:
+        data = CATALOG.get_loadout(catalog_ids or [])
     elif example:
-        data = EXAMPLE_DATA
-        data, spread_labels = add_spreads(data, *spreads)
-        weapons, output_str = get_weapon_text(data)
+        data = [dict(wpn) for wpn in EXAMPLE_DATA]
     else:
-        if data is not None:
-            data, spread_labels = add_spreads(data, *spreads)
-            weapons, output_str = get_weapon_text(data)
-        else:
-            weapons = ["N/A" for _ in range(MAX_WEAPONS)]
-            output_str = "Copy a share link and click 'Fetch data' to get started."
-    weapon_options = [{'label': wpn, 'value': i} for i, wpn in enumerate(weapons) if wpn != 'N/A']
-    if len(weapon_options) > 0:
-        weapon = weapon_options[0]['value']
+        return None, "Copy a share link and click 'Fetch data' to get started.", [], None, []
+    data = data[:MAX_WEAPONS]
+    spreads = [spreads[i] if i < len(spreads) else (DEFAULT_SPREAD, DEFAULT_SPREAD) for i in range(len(data))]
+    weapons, output_str = get_weapon_text(data)
+    weapon_options = [{'label': wpn, 'value': i} for i, wpn in enumerate(weapons)]
+    weapon = 0 if len(weapon_options) > 0 else None
+    updatemode = 'drag' if live == 'on' else 'mouseup'
+    rows = make_recoil_rows(weapons, spreads, updatemode=updatemode)
+    return data, output_str, weapon_options, weapon, rows
+
+
+def get_permalink_entry(state):
+    """
+    Results and figure of a permalink state, computed and stored if they are not in the permalink store
+
+    :param state: state dict from `permalink.decode_state`
+    :return: dict with the stored results ('results') and figure JSON ('figure')
+    """
+    key = permalink.get_state_key(state)
+    entry = PERMALINK_STORE.get(key)
+    if entry is None:
+        distances = np.linspace(10, state['distance'], state['distance'])
+        results = utils.analyze(
+            state['weapons'], distances, AIM_CENTER_DICT[state['aim_center']], ads=(state['ads'] == 'yes'),
+            target=state['target'], hp=np.array(HP_LEVELS), cache=RESULTS_CACHE, aim_error=state['aim_error'] / 100.,
+        )
+        fig = utils.plot_results(
+            distances, state['weapons'], results, mode=state['mode'], log_x=(state['x_mode'] == 'log'),
+            log_y=(state['y_mode'] == 'log'), show_nr=state['show_nr'], show_hp=state['hp'],
+        )
+        entry = dict(results=results.to_store(), figure=fig.to_json())
+        PERMALINK_STORE.put(key, entry)
+    return entry
+
+
+def check_permalink_state(state):
+    """
+    Check that a decoded permalink state only holds values the inputs can take
+
+    :param state: state dict from `permalink.decode_state`
+    :raises ValueError: if it does not
+    """
+    if not 0 < len(state['weapons']) <= MAX_WEAPONS:
+        raise ValueError(f"Permalinks hold 1 to {MAX_WEAPONS} weapons")
+    if state['aim_center'] not in AIM_CENTER_DICT or state['target'] not in hitboxes.HITBOXES:
+        raise ValueError("Invalid aim center or target in permalink")
+    if state['mode'] not in ('ttk', 'stk', 'dps') or state['ads'] not in ('yes', 'no'):
+        raise ValueError("Invalid plot settings in permalink")
+    if not isinstance(state['distance'], int) or not 10 <= state['distance'] <= 150:
+        raise ValueError("Invalid distance in permalink")
+    if not isinstance(state['hp'], list) or any(hp not in HP_LEVELS for hp in state['hp']):
+        raise ValueError("Invalid target HP in permalink")
+    if not isinstance(state['aim_error'], (int, float)) or not 0 <= state['aim_error'] <= 30:
+        raise ValueError("Invalid aim error in permalink")
+
+
+@app.callback(
+    [Output('permalink-store', 'data'),
+     Output('radio-aim-center', 'value'),
+     Output('radio-plot-ads', 'value'),
+     Output('distance-input', 'value'),
+     Output('radio-target', 'value'),
+     Output('checklist-hp', 'value'),
+     Output('radio-plot-mode', 'value'),
+     Output('radio-x-axis', 'value'),
+     Output('radio-y-axis', 'value'),
+     Output('radio-show-nr', 'value'),
+     Output('aim-error-input', 'value')],
+    [Input('url', 'search')]
+)
+def restore_permalink(search):
+    """
+    Restore the inputs of a permalink opened with "?p=<id>" or "?s=<token>"
+
+    :param search: URL query string
+    :return: permalink store data and input values
+    """
+    query = parse_qs((search or '').lstrip('?'))
+    if 'p' in query:
+        token = PERMALINK_LINKS.get(query['p'][0])
+        if token is None:
+            return (dict(error="Unknown permalink; open its self-contained link instead"),) \
+                + tuple(dash.no_update for _ in permalink.SETTINGS)
+    elif 's' in query:
+        token = query['s'][0]
     else:
-        weapon = None
-    return (data,) + (output_str, weapon_options, weapon) + tuple(weapons) + tuple(spread_labels)
+        raise PreventUpdate
+    try:
+        state = permalink.decode_state(token)
+        check_permalink_state(state)
+    except ValueError as e:
+        return (dict(error=str(e)),) + tuple(dash.no_update for _ in permalink.SETTINGS)
+    # Spreads are restored with the recoil rows, see `update_data`
+    return (dict(state=state),) + tuple(state[k] for k in permalink.SETTINGS)
+
+
+@app.callback(
+    [Output('permalink-output', 'value'),
+     Output('permalink-fallback', 'children'),
+     Output('permalink-fallback', 'href')],
+    [Input('permalink-button', 'n_clicks')],
+    [State('weapons-data-store', 'data'),
+     State('radio-aim-center', 'value'),
+     State('radio-plot-ads', 'value'),
+     State('distance-input', 'value'),
+     State('radio-target', 'value'),
+     State('checklist-hp', 'value'),
+     State('radio-plot-mode', 'value'),
+     State('radio-x-axis', 'value'),
+     State('radio-y-axis', 'value'),
+     State('radio-show-nr', 'value'),
+     State('aim-error-input', 'value'),
+     State('url', 'href'),
+     spread_state]
+)
+def create_permalink(n_clicks, data, aim_center_select, ads, d_max, target, show_hp, mode, x_mode, y_mode, show_nr,
+                     aim_error, href, spreads):
+    """
+    Create a permalink to the current setup and precompute its results
+
+    :return: short permalink URL, and the text and URL of the self-contained link
+    """
+    if not n_clicks:
+        raise PreventUpdate
+    if data is None or len(data) == 0:
+        return "", "", ""
+    data = add_spreads(data, spreads)
+    token = permalink.encode_state(dict(
+        weapons=data, aim_center=aim_center_select, ads=ads, distance=d_max, target=target, hp=show_hp, mode=mode,
+        x_mode=x_mode, y_mode=y_mode, show_nr=show_nr, aim_error=aim_error,
+    ))
+    get_permalink_entry(permalink.decode_state(token))
+    base_url = (href or '').split('?')[0]
+    return f"{base_url}?p={PERMALINK_LINKS.put(token)}", "Self-contained link", f"{base_url}?s={token}"
+
+
+@app.callback(
+    Output('catalog-dropdown', 'options'),
+    [Input('catalog-dropdown', 'search_value')],
+    [State('catalog-dropdown', 'value')]
+)
+def update_catalog_options(search_value, selected):
+    """
+    Catalog weapons matching the typed prefix, plus the ones already selected
+
+    :param search_value: text typed into the dropdown
+    :param selected: selected weapon ids
+    :return: dropdown options
+    """
+    weapons = CATALOG.get_loadout(selected or [])
+    if search_value:
+        weapons.extend(CATALOG.search(search_value))
+    options = {}
+    for wpn in weapons:
+        # Builds of the same gun differ in their attachment-dependent stats
+        build = f"{wpn['fire_rate']:g} rpm, {wpn['mag_size']:g} rounds, {wpn['ads']:g} ms ADS"
+        details = ', '.join(v for v in (wpn['mode'], wpn['damage_type'], build) if v)
+        options[catalog.get_weapon_id(wpn)] = f"{wpn['gun']} ({details})"
+    return [{'label': label, 'value': weapon_id} for weapon_id, label in options.items()]
 
 
 def get_weapon_text(data):
     weapons = [d['gun'] for d in data]
-    if len(weapons) < MAX_WEAPONS:
-        weapons.extend(["N/A" for _ in range(MAX_WEAPONS - len(weapons))])
-    output_str = f"{len(data)} weapons found: " + ', '.join(weapons[:len(data)])
+    output_str = f"{len(data)} weapons found: " + ', '.join(weapons)
     return weapons, output_str
 
 
@@ -668,27 +1034,101 @@ def toggle_fetch_help(n_clicks, is_open):
     return is_open
 
 
+# Plot requests hold the weapons, spreads and settings of the latest plot. They are only written when the
+# Plot button is clicked, a permalink is opened, or a recoil slider moves in live mode, so slider ticks in
+# the default mode do not reach the plot callback
+app.clientside_callback(
+    """
+    function(n_clicks, spreads, live, linked, data, aim_center, ads, distance, target, aim_error, previous) {
+        var triggered = dash_clientside.callback_context.triggered.map(function(t) { return t.prop_id; });
+        var request;
+        if (triggered.indexOf('permalink-store.data') >= 0) {
+            if (!linked || !linked.state) {
+                return dash_clientside.no_update;
+            }
+            var state = linked.state;
+            request = {weapons: state.weapons, aim_center: state.aim_center, ads: state.ads,
+                       distance: state.distance, target: state.target, aim_error: state.aim_error};
+        } else {
+            var clicked = n_clicks && triggered.indexOf('plot-button.n_clicks') >= 0;
+            var live_update = live === 'on' && triggered.some(function(id) {
+                return id === 'radio-live.value' || id.indexOf('spread-store') >= 0;
+            });
+            if (!clicked && !live_update) {
+                return dash_clientside.no_update;
+            }
+            var weapons = (data || []).slice(0, spreads.length).map(function(wpn, i) {
+                return Object.assign({}, wpn, {spread: spreads[i]});
+            });
+            request = {weapons: weapons, aim_center: aim_center, ads: ads, distance: distance, target: target,
+                       aim_error: aim_error};
+        }
+        request.n = previous ? previous.n + 1 : 1;
+        return request;
+    }
+    """,
+    Output('plot-request-store', 'data'),
+    [Input('plot-button', 'n_clicks'),
+     spread_input,
+     Input('radio-live', 'value'),
+     Input('permalink-store', 'data')],
+    [State('weapons-data-store', 'data'),
+     State('radio-aim-center', 'value'),
+     State('radio-plot-ads', 'value'),
+     State('distance-input', 'value'),
+     State('radio-target', 'value'),
+     State('aim-error-input', 'value'),
+     State('plot-request-store', 'data')]
+)
+
+
+def get_plot_inputs(request):
+    """
+    Analysis inputs of a plot request
+
+    :param request: data of 'plot-request-store'
+    :return: weapons, distances, aim center and `utils.analyze` keyword arguments
+    """
+    weapons = [dict(wpn, spread=(float(wpn['spread'][0]), float(wpn['spread'][1]))) for wpn in request['weapons']]
+    distances = np.linspace(10, request['distance'], request['distance'])
+    kwargs = dict(ads=(request['ads'] == 'yes'), target=request['target'], hp=np.array(HP_LEVELS),
+                  cache=RESULTS_CACHE, aim_error=request['aim_error'] / 100.)
+    return weapons, distances, AIM_CENTER_DICT[request['aim_center']], kwargs
+
+
 @app.callback(
     [Output('perf-plot-figure', 'figure'),
      Output('perf-plot-err', 'children'),
      Output('perf-plot-header', 'children'),
      Output('perf-plot-store', 'data'),
-     Output('results-store', 'data')],
-    [Input('plot-button', 'n_clicks'),
+     Output('results-store', 'data'),
+     Output('plot-interval', 'disabled'),
+     Output('plot-job-store', 'data')],
+    [Input('plot-request-store', 'data'),
      Input('radio-x-axis', 'value'),
      Input('radio-y-axis', 'value'),
-     Input('radio-show-nr', 'value')],
-    [State('weapons-data-store', 'data'),
-     State('perf-plot-store', 'data'),
+     Input('radio-show-nr', 'value'),
+     Input('radio-show-sens', 'value'),
+     Input('checklist-hp', 'value'),
+     Input('permalink-store', 'data'),
+     Input('plot-interval', 'n_intervals')],
+    [State('perf-plot-store', 'data'),
      State('radio-plot-mode', 'value'),
-     State('results-store', 'data'),
-     State('radio-aim-center', 'value'),
-     State('radio-plot-ads', 'value'),
-     State('distance-input', 'value')] + spread_states
+     State('session-id', 'data'),
+     State('plot-job-store', 'data')]
 )
-def update_plot(n_clicks, x_mode, y_mode, show_nr, data, stored_mode, new_mode, results, aim_center_select, ads, d_max, *spreads):
+def update_plot(request, x_mode, y_mode, show_nr, show_sens, show_hp, linked, n_intervals, stored_mode, new_mode,
+                session_id, seen_version):
+    """
+    Plot the latest plot request, drawing each weapon's curves as they come in. Display changes redraw
+    from the per-weapon results cache, so the stored results are never sent back to the server.
+    """
     button_id = get_button_pressed()
-    plot = (button_id == 'plot-button')
+    plot = (button_id == 'plot-request-store')
+    poll = (button_id == 'plot-interval')
+    sensitivity = (show_sens == 'show')
+    if button_id == 'radio-show-sens' and sensitivity and request is not None:
+        plot = True     # sensitivities are computed in the background, like a new plot
     header_mode = {
         'ttk': "(Time-to-kill)",
         'stk': "(Shots-to-kill)",
@@ -696,62 +1136,213 @@ def update_plot(n_clicks, x_mode, y_mode, show_nr, data, stored_mode, new_mode,
     }
     log_x = (x_mode == 'log')
     log_y = (y_mode == 'log')
-    distances = np.linspace(10, d_max, d_max)
+    weapons = request['weapons'] if request is not None else None
+    if weapons:
+        weapons, distances, center, kwargs = get_plot_inputs(request)
+    else:
+        distances = np.linspace(10, DEFAULT_MAX_DISTANCE, DEFAULT_MAX_DISTANCE)
     fig = None
     msg = ""
 
-    if plot:
-        mode = new_mode
-        if len(data) > 0:
-            results = utils.analyze(data, distances, AIM_CENTER_DICT[aim_center_select], ads=(ads == 'yes'))
-            fig = utils.plot_results(distances, data, results, mode=mode, log_x=log_x, log_y=log_y, show_nr=show_nr)
+    if 'permalink-store.data' in get_triggered() and linked is not None:
+        if 'error' in linked:
+            msg = linked['error']
         else:
-            msg = "No data found. Fetch data first!"
-    else:
-        mode = stored_mode
-        if data is not None and results is not None:
-            fig = utils.plot_results(distances, data, results, mode=mode, log_x=log_x, log_y=log_y, show_nr=show_nr)
+            # Linked results come straight from the permalink store when they are cached
+            state = linked['state']
+            entry = get_permalink_entry(state)
+            header = "Simulated performance plot " + header_mode[state['mode']]
+            return json.loads(entry['figure']), msg, header, state['mode'], entry['results'], True, dash.no_update
+
+    if plot or poll:
+        if plot:
+            mode = new_mode
+            if not weapons:
+                fig = utils.plot_results(distances, weapons, None, mode=mode, log_x=log_x, log_y=log_y,
+                                         show_nr=show_nr)
+                header = "Simulated performance plot " + header_mode[mode]
+                return fig, "No data found. Fetch data first!", header, mode, dash.no_update, True, dash.no_update
+
+            def iter_snapshots(is_cancelled):
+                for partial, w, _ in utils.iter_analyze(weapons, distances, center, is_cancelled=is_cancelled,
+                                                        sensitivity=sensitivity, **kwargs):
+                    yield AnalysisResults(partial.guns[:w + 1], partial.distances, partial.hp,
+                                          data=partial.data[:, :w + 1].copy(), sensitivity=sensitivity)
+
+            job = SCHEDULER.start((session_id, 'plot'), iter_snapshots)
+            version, snapshot, done = job.wait(timeout=FIRST_CURVE_TIMEOUT)
+        else:
+            mode = stored_mode
+            job = SCHEDULER.get_job((session_id, 'plot'))
+            if job is None:
+                # The job runs on another worker process or has expired, so finish the plot here; weapons
+                # this process already computed come from its cache
+                if not weapons:
+                    return (dash.no_update,) * 5 + (True, dash.no_update)
+                try:
+                    snapshot = utils.analyze(weapons, distances, center, sensitivity=sensitivity, **kwargs)
+                except ValueError as e:
+                    return dash.no_update, str(e), dash.no_update, dash.no_update, dash.no_update, True, dash.no_update
+                fig = utils.plot_results(snapshot.distances, weapons, snapshot, mode=mode, log_x=log_x, log_y=log_y,
+                                         show_nr=show_nr, show_hp=show_hp, show_sens=sensitivity)
+                header = "Simulated performance plot " + header_mode[mode]
+                return fig, msg, header, mode, snapshot.to_store(), True, dash.no_update
+            version, snapshot, done = job.wait(seen_version or 0, timeout=0)
+            if version == seen_version and not done:
+                raise PreventUpdate
+        if job.cancelled:
+            raise PreventUpdate     # superseded by a newer plot request, which takes over the polling
+        if job.error is not None:
+            msg = str(job.error)
+            done = True
+        header = "Simulated performance plot " + header_mode[mode]
+        if done:
+            SCHEDULER.discard_job((session_id, 'plot'), job)     # its final snapshot is delivered below
+        if snapshot is None:
+            fig = utils.plot_results(distances, weapons, None, mode=mode, log_x=log_x, log_y=log_y, show_nr=show_nr)
+            return fig, msg, header, mode, dash.no_update, done, version
+        fig = utils.plot_results(snapshot.distances, weapons, snapshot, mode=mode, log_x=log_x, log_y=log_y,
+                                 show_nr=show_nr, show_hp=show_hp, show_sens=sensitivity)
+        results = snapshot.to_store() if done and job.error is None else dash.no_update
+        return fig, msg, header, mode, results, done, version
+
+    mode = stored_mode
+    if weapons:
+        if SCHEDULER.get_job((session_id, 'plot')) is not None:
+            raise PreventUpdate     # the plot is still coming in, and the next poll draws it with these settings
+        try:
+            results = utils.analyze(weapons, distances, center, sensitivity=sensitivity, **kwargs)
+            fig = utils.plot_results(results.distances, weapons, results, mode=mode, log_x=log_x, log_y=log_y,
+                                     show_nr=show_nr, show_hp=show_hp, show_sens=sensitivity)
+        except ValueError as e:
+            msg = str(e)
     header = "Simulated performance plot " + header_mode[mode]
     if fig is None:
-        fig = utils.plot_results(distances, data, results, mode=mode, log_x=log_x, log_y=log_y, show_nr=show_nr)
-    return fig, msg, header, mode, results
+        fig = utils.plot_results(distances, weapons, None, mode=mode, log_x=log_x, log_y=log_y, show_nr=show_nr)
+    return fig, msg, header, mode, dash.no_update, dash.no_update, dash.no_update
+
+
+@app.callback(
+    Output('duel-figure', 'figure'),
+    [Input('results-store', 'data'),
+     Input('duel-distance-input', 'value'),
+     Input('checklist-hp', 'value')]
+)
+def update_duel(results, duel_distance, show_hp):
+    """
+    Update head-to-head win margin heatmap at the chosen distance
+
+    :param results: stored analysis results
+    :param duel_distance: distance in meters
+    :param show_hp: selected hp levels, the highest one is used
+    :return: figure
+    """
+    if results is None:
+        return duel.plot_win_matrix([], np.zeros((0, 0, 1)), 0)
+    results = AnalysisResults.from_store(results)
+    hp = max(show_hp) if show_hp else utils.DEFAULT_TARGET_HP
+    hp_index = int(np.argmin(np.abs(results.hp - hp)))
+    distance_idx = int(np.argmin(np.abs(results.distances - duel_distance)))
+    margins = duel.get_results_margins(results, hp_index=hp_index)
+    return duel.plot_win_matrix(results.guns, margins, distance_idx, distance=results.distances[distance_idx])
+
+
+# Shows the sprite sheet frame nearest to the slider distance without a server round trip
+app.clientside_callback(
+    """
+    function(distance, flipbook) {
+        var label = distance + ' m';
+        if (!flipbook) {
+            return [{display: 'none'}, label];
+        }
+        var n = flipbook.distances.length;
+        var i = 0;
+        for (var j = 1; j < n; j++) {
+            if (Math.abs(flipbook.distances[j] - distance) < Math.abs(flipbook.distances[i] - distance)) {
+                i = j;
+            }
+        }
+        return [{
+            width: '80%',
+            margin: '0 auto',
+            paddingTop: (80 * flipbook.aspect) + '%',
+            backgroundImage: 'url(' + flipbook.src + ')',
+            backgroundSize: '100% ' + (100 * n) + '%',
+            backgroundPosition: '0 ' + (n > 1 ? 100 * i / (n - 1) : 0) + '%',
+        }, label];
+    }
+    """,
+    [Output('target-img', 'style'),
+     Output('target-distance-div', 'children')],
+    [Input('target-distance-input', 'value'),
+     Input('target-flipbook-store', 'data')]
+)
+
+
+# The selected weapon with its spread, only written when it changes, so moving another weapon's slider
+# does not reach the image callback
+app.clientside_callback(
+    """
+    function(wpn_idx, spreads, data, previous) {
+        var wpn = null;
+        if (data && wpn_idx !== null && wpn_idx !== undefined && wpn_idx < data.length && spreads[wpn_idx]) {
+            wpn = Object.assign({}, data[wpn_idx], {spread: spreads[wpn_idx]});
+        }
+        if (JSON.stringify(wpn) === JSON.stringify(previous)) {
+            return dash_clientside.no_update;
+        }
+        return wpn;
+    }
+    """,
+    Output('selected-weapon-store', 'data'),
+    [Input('wpn-dropdown', 'value'),
+     spread_input,
+     Input('weapons-data-store', 'data')],
+    [State('selected-weapon-store', 'data')]
+)
 
 
 @app.callback(
-    Output('target-img', 'src'),
+    Output('target-flipbook-store', 'data'),
     [Input('radio-aim-center', 'value'),
-     Input('target-distance-input', 'value'),
      Input('zoom-input', 'value'),
      Input('fov-input', 'value'),
-     Input('wpn-dropdown', 'value')] + spread_inputs,
-    [State('weapons-data-store', 'data')]
+     Input('selected-weapon-store', 'data'),
+     Input('radio-target', 'value'),
+     Input('aim-error-input', 'value')],
+    [State('session-id', 'data')]
 )
-def update_image(aim_center_select, dist, zoom, fov, wpn_idx, *spreads_and_data):
+def update_image(aim_center_select, zoom, fov, wpn, target, aim_error, session_id):
     """
-    Update image of recoil spread and enemy hit-box
+    Update the sprite sheet of recoil spread and enemy hit-box images at all TARGET_DISTANCES
 
-    :param aim_center_pct:
-    :param dist:
+    :param aim_center_select:
     :param zoom:
     :param fov:
-    :param wpn_idx:
-    :param spreads_and_data:
-    :return: figure URI, error message
-    """
-    spreads = spreads_and_data[:-1]
-    data = spreads_and_data[-1]
-    if data is not None:
-        if len(data) > 0:
-            if wpn_idx is None:
-                return ""
-            data, spreads = add_spreads(data, *spreads)
-            target_fig = utils.plot_beam_profile(data[wpn_idx], dist, AIM_CENTER_DICT[aim_center_select], zoom=zoom, fov=fov)
-            target_fig_uri = fig_to_uri(target_fig)
-            return target_fig_uri
-        else:
-            return ""
-    else:
-        return ""
+    :param wpn: selected weapon data with its (x, y) spread in degrees
+    :param target:
+    :param aim_error: aim error in centimeters
+    :param session_id:
+    :return: dict with the sprite sheet URI ('src'), frame distances and frame aspect ratio, or None
+    """
+    if wpn is None:
+        return None
+    wpn = dict(wpn, spread=(float(wpn['spread'][0]), float(wpn['spread'][1])))
+    key = make_key(list(wpn['spread']), aim_center_select, zoom, fov, target, aim_error)
+    src = FLIPBOOK_CACHE.get(key)
+    if src is None:
+        try:
+            src = SCHEDULER.run(
+                (session_id, 'image'),
+                lambda is_cancelled: fig_to_uri(utils.plot_beam_flipbook(
+                    wpn, TARGET_DISTANCES, AIM_CENTER_DICT[aim_center_select], zoom=zoom, fov=fov,
+                    target=target, aim_error=aim_error / 100.
+                ))
+            )
+        except AnalysisCancelled:
+            raise PreventUpdate
+        FLIPBOOK_CACHE.put(key, src)
+    return dict(src=src, distances=TARGET_DISTANCES, aspect=1 / utils.SCREEN_ASPECT)
 
 
 if __name__ == '__main__':
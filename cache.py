@@ -0,0 +1,85 @@
+"""
+In-process caches for analysis results and rendered figures.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def make_key(*parts):
+    """
+    Content hash of JSON-like values and numpy arrays
+
+    :param parts: values to hash, in order
+    :return: hex digest
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(f"{part.dtype.str}{part.shape}".encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(json.dumps(part, sort_keys=True, default=float).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache with a bounded number of entries,
+    and optionally a bounded total size
+    """
+
+    def __init__(self, max_items=128, max_bytes=None, sizeof=None):
+        """
+        :param max_items: maximum number of entries
+        :param max_bytes: maximum total size of the entries, unbounded if None
+        :param sizeof: callable returning the size in bytes of a value, required with `max_bytes`
+        """
+        if max_bytes is not None and sizeof is None:
+            raise ValueError("A size-bounded cache needs a sizeof function")
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.num_bytes = 0
+        self._items = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if self.max_bytes is not None and size > self.max_bytes:
+                return      # would evict everything else and still not fit
+            self.num_bytes += size - self._sizes.get(key, 0)
+            self._items[key] = value
+            self._sizes[key] = size
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items or (
+                    self.max_bytes is not None and self.num_bytes > self.max_bytes):
+                old_key, _ = self._items.popitem(last=False)
+                self.num_bytes -= self._sizes.pop(old_key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self.num_bytes = 0
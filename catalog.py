@@ -0,0 +1,275 @@
+"""
+Local SQLite catalog of weapon stats and damage profiles.
+
+Weapons are stored with the fields `truegamedata.get_weapons_data` builds and
+indexed by gun name, game mode and damage type, so loadouts can be built by
+prefix search without any TrueGameData requests. Stats depend on the attachments
+of a build, so every distinct build of a gun is kept as its own row, identified
+by a hash of its stats, and the " (2)" suffixes that `get_weapons_data` gives
+repeated guns in one loadout are dropped from the stored names. Import saved
+`truegamedata.py -o` files and query the catalog with:
+
+    python catalog.py import saved1.json saved2.json
+    python catalog.py search kil
+    python catalog.py loadout "Kilo 141" M13 -o loadout.json
+"""
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+from argparse import ArgumentParser
+
+
+DEFAULT_CATALOG_FILEPATH = 'weapons.db'
+DEFAULT_DAMAGE_TYPE = 'Default'
+DEFAULT_SEARCH_LIMIT = 20
+# Bump whenever the table layout changes; older catalogs are migrated on open
+CATALOG_VERSION = 2
+
+# Stat columns, in the order of the table definition
+STAT_FIELDS = ('fire_rate', 'range_modifier', 'ads', 'sprint_to_fire', 'tactical_sprint_to_fire', 'bullet_velocity',
+               'reload_time', 'mag_size')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS weapons (
+    gun TEXT NOT NULL,
+    gun_key TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    damage_type TEXT NOT NULL,
+    fire_rate REAL NOT NULL,
+    range_modifier REAL,
+    ads REAL NOT NULL,
+    sprint_to_fire REAL,
+    tactical_sprint_to_fire REAL,
+    bullet_velocity REAL NOT NULL,
+    reload_time REAL NOT NULL,
+    mag_size INTEGER NOT NULL,
+    damage_profile TEXT NOT NULL,
+    build TEXT NOT NULL,
+    PRIMARY KEY (gun, mode, damage_type, build)
+);
+CREATE INDEX IF NOT EXISTS weapons_by_name ON weapons (gun_key, mode, damage_type);
+CREATE INDEX IF NOT EXISTS weapons_by_mode ON weapons (mode, damage_type, gun_key);
+"""
+
+
+def get_base_gun_name(gun):
+    """Gun name without the " (2)" suffix `get_weapons_data` gives repeated guns in one loadout"""
+    return re.sub(r' \(\d+\)$', '', gun)
+
+
+def get_build_key(wpn):
+    """
+    Hash of the attachment-dependent stats and damage profile of a weapon
+
+    :param wpn: weapon data dict
+    :return: str
+    """
+    stats = [None if wpn.get(k) is None else float(wpn[k]) for k in STAT_FIELDS]
+    return hashlib.sha256(json.dumps([stats, wpn['damage_profile']], sort_keys=True).encode()).hexdigest()[:12]
+
+
+def get_gun_key(gun):
+    """Case-folded gun name used for prefix search"""
+    return gun.casefold()
+
+
+def get_weapon_id(wpn):
+    """
+    String id of a catalog weapon, e.g. for UI option values
+
+    :param wpn: weapon data dict from the catalog
+    :return: str
+    """
+    return json.dumps([wpn['gun'], wpn['mode'], wpn['damage_type'], wpn['build']])
+
+
+class WeaponCatalog:
+    """
+    Thread-safe SQLite weapon catalog
+    """
+
+    def __init__(self, filepath=DEFAULT_CATALOG_FILEPATH):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filepath, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            old_rows = self._migrate()
+            self._conn.executescript(SCHEMA)
+            self._conn.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+        if old_rows:
+            self.import_weapons([self._to_weapon(row) for row in old_rows])
+
+    def _migrate(self):
+        """Drop a table from an older catalog version, returning its rows for re-import"""
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        exists = self._conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'weapons'"
+        ).fetchone()
+        if version >= CATALOG_VERSION or exists is None:
+            return []
+        rows = self._conn.execute("SELECT * FROM weapons").fetchall()
+        self._conn.execute("DROP TABLE weapons")
+        return rows
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def import_weapons(self, weapons, mode='', damage_type=DEFAULT_DAMAGE_TYPE):
+        """
+        Add weapons in one transaction; a build that is already in the catalog is replaced
+
+        :param weapons: list of weapon data dicts in the `get_weapons_data` schema
+        :param mode: game mode for weapons without a 'mode' entry
+        :param damage_type: damage type for weapons without a 'damage_type' entry
+        :return: number of weapons imported
+        """
+        rows = []
+        for i, wpn in enumerate(weapons):
+            missing = [k for k in ('gun', 'fire_rate', 'ads', 'bullet_velocity', 'reload_time', 'mag_size',
+                                   'damage_profile') if k not in wpn]
+            if missing:
+                raise ValueError(f"Weapon {i} is missing {', '.join(missing)}")
+            gun = get_base_gun_name(wpn['gun'])
+            rows.append((
+                gun,
+                get_gun_key(gun),
+                wpn.get('mode', mode),
+                wpn.get('damage_type', damage_type),
+                *[wpn.get(k) for k in STAT_FIELDS],
+                json.dumps(wpn['damage_profile']),
+                get_build_key(wpn),
+            ))
+        columns = ('gun', 'gun_key', 'mode', 'damage_type') + STAT_FIELDS + ('damage_profile', 'build')
+        query = (f"INSERT OR REPLACE INTO weapons ({', '.join(columns)}) "
+                 f"VALUES ({', '.join('?' for _ in columns)})")
+        with self._lock, self._conn:
+            self._conn.executemany(query, rows)
+        return len(rows)
+
+    def import_file(self, filepath, mode='', damage_type=DEFAULT_DAMAGE_TYPE):
+        """
+        Import a weapon data JSON file, e.g. from `truegamedata.py -o`
+
+        :return: number of weapons imported
+        """
+        with open(filepath, 'r') as f:
+            return self.import_weapons(json.load(f), mode=mode, damage_type=damage_type)
+
+    def search(self, prefix='', mode=None, damage_type=None, limit=DEFAULT_SEARCH_LIMIT):
+        """
+        Weapons whose name starts with `prefix`, case-insensitively, in name order
+
+        :param prefix: start of the gun name
+        :param mode: only weapons of this game mode
+        :param damage_type: only weapons of this damage type
+        :param limit: maximum number of results
+        :return: list of weapon data dicts
+        """
+        key = get_gun_key(prefix)
+        # Range scan on the name index instead of LIKE, which SQLite cannot index case-insensitively by default
+        conditions = ["gun_key >= ?", "gun_key < ?"]
+        params = [key, key + '\U0010ffff']
+        if mode is not None:
+            conditions.append("mode = ?")
+            params.append(mode)
+        if damage_type is not None:
+            conditions.append("damage_type = ?")
+            params.append(damage_type)
+        query = f"SELECT * FROM weapons WHERE {' AND '.join(conditions)} ORDER BY gun_key, mode, damage_type LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [self._to_weapon(row) for row in rows]
+
+    def get(self, gun, mode='', damage_type=DEFAULT_DAMAGE_TYPE, build=None):
+        """
+        :param build: build key from `get_build_key`, defaults to the most recently imported build
+        :return: weapon data dict, or None if it is not in the catalog
+        """
+        query = "SELECT * FROM weapons WHERE gun = ? AND mode = ? AND damage_type = ?"
+        params = [gun, mode, damage_type]
+        if build is not None:
+            query += " AND build = ?"
+            params.append(build)
+        with self._lock:
+            row = self._conn.execute(query + " ORDER BY rowid DESC LIMIT 1", params).fetchone()
+        return None if row is None else self._to_weapon(row)
+
+    def get_loadout(self, weapon_ids):
+        """
+        Weapons by id, in order, skipping ids that are not in the catalog
+
+        Repeated guns, e.g. two builds of one gun, get the same " (2)" suffixes as in
+        `get_weapons_data`, since results and plots look weapons up by name.
+
+        :param weapon_ids: ids from `get_weapon_id`
+        :return: list of weapon data dicts
+        """
+        out = []
+        gun_counts = {}
+        for weapon_id in weapon_ids:
+            wpn = self.get(*json.loads(weapon_id))
+            if wpn is not None:
+                gun = wpn['gun']
+                gun_counts[gun] = gun_counts.get(gun, 0) + 1
+                if gun_counts[gun] > 1:
+                    wpn['gun'] = f"{gun} ({gun_counts[gun]})"
+                out.append(wpn)
+        return out
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM weapons").fetchone()[0]
+
+    @staticmethod
+    def _to_weapon(row):
+        wpn = dict(gun=row['gun'])
+        for k in STAT_FIELDS:
+            if row[k] is not None:
+                wpn[k] = row[k]
+        wpn['damage_profile'] = json.loads(row['damage_profile'])
+        wpn['mode'] = row['mode']
+        wpn['damage_type'] = row['damage_type']
+        wpn['build'] = row['build'] if 'build' in row.keys() else get_build_key(wpn)
+        return wpn
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Local weapon catalog")
+    parser.add_argument("-c", "--catalog", default=DEFAULT_CATALOG_FILEPATH)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help="import `truegamedata.py -o` JSON files")
+    import_parser.add_argument("files", nargs='+')
+    import_parser.add_argument("-m", "--mode", default='', help="mode for weapons saved without one")
+    import_parser.add_argument("-t", "--damage-type", default=DEFAULT_DAMAGE_TYPE)
+    search_parser = subparsers.add_parser('search', help="list weapons by name prefix")
+    search_parser.add_argument("prefix", nargs='?', default='')
+    search_parser.add_argument("-m", "--mode")
+    search_parser.add_argument("-n", "--limit", type=int, default=DEFAULT_SEARCH_LIMIT)
+    loadout_parser = subparsers.add_parser('loadout', help="write the first match of each prefix to a JSON loadout")
+    loadout_parser.add_argument("prefixes", nargs='+')
+    loadout_parser.add_argument("-m", "--mode")
+    loadout_parser.add_argument("-o", "--output", default="loadout.json")
+    args = parser.parse_args()
+
+    catalog = WeaponCatalog(args.catalog)
+    if args.command == 'import':
+        for filepath in args.files:
+            print(f"{filepath}: {catalog.import_file(filepath, mode=args.mode, damage_type=args.damage_type)} weapons")
+    elif args.command == 'search':
+        for wpn in catalog.search(args.prefix, mode=args.mode, limit=args.limit):
+            print(f"{wpn['gun']}\t{wpn['mode']}\t{wpn['damage_type']}\t{wpn['build']}")
+    else:
+        loadout = []
+        for prefix in args.prefixes:
+            matches = catalog.search(prefix, mode=args.mode, limit=1)
+            if not matches:
+                parser.error(f"No weapon matches '{prefix}'")
+            loadout.extend(matches)
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(loadout, indent=2))
+        print(f"Wrote {len(loadout)} weapons to {args.output}")
@@ -0,0 +1,99 @@
+"""
+Head-to-head duel analysis across a loadout.
+
+For every pair of weapons (i, j) and every distance, the win margin is how much
+sooner weapon i kills than weapon j: margin[i, j, d] = ttk[j, d] - ttk[i, d].
+Positive margins mean weapon i wins the duel. Batch export:
+
+    python duel.py weapons.json -o duel.npz
+"""
+import json
+from argparse import ArgumentParser
+
+import numpy as np
+import plotly.graph_objects as go
+
+import utils
+
+
+def get_win_margins(ttk, ads_times=None):
+    """
+    Pairwise win margins from TTK curves in one broadcast
+
+    :param ttk: array (weapon, distance) of time-to-kill in seconds
+    :param ads_times: optional (weapon,) times in seconds added to each weapon's TTK, e.g. ADS time
+        when the TTK was computed without it
+    :return: array (weapon, weapon, distance) of margins in seconds
+    """
+    ttk = np.asarray(ttk, dtype=float)
+    if ads_times is not None:
+        ttk = ttk + np.asarray(ads_times, dtype=float)[:, None]
+    return ttk[None, :, :] - ttk[:, None, :]
+
+
+def get_results_margins(results, hp_index=-1, recoil=True):
+    """
+    Pairwise win margins from `utils.analyze` results
+
+    :param results: AnalysisResults
+    :param hp_index: index along the hp axis
+    :param recoil: use recoil-adjusted TTK, otherwise the no-recoil TTK
+    :return: array (weapon, weapon, distance) of margins in seconds
+    """
+    ttk = results.ttk if recoil else results.ttk_nr
+    return get_win_margins(ttk[:, :, hp_index])
+
+
+def plot_win_matrix(guns, margins, distance_idx, distance=None):
+    """
+    Heatmap of win margins at one distance
+
+    :param guns: weapon names
+    :param margins: array from `get_win_margins`
+    :param distance_idx: index along the distance axis
+    :param distance: distance in meters, for the title
+    :return: plotly Figure
+    """
+    z = margins[:, :, distance_idx]
+    z_max = max(np.abs(z).max(initial=0), 1e-3)
+    fig = go.Figure(go.Heatmap(
+        z=z,
+        x=guns,
+        y=guns,
+        zmid=0,
+        zmin=-z_max,
+        zmax=z_max,
+        colorscale='RdBu',
+        colorbar=dict(title="Margin [s]"),
+        hovertemplate="%{y} vs %{x}: %{z:.3f} s<extra></extra>",
+    ))
+    title = "Win margin of row weapon over column weapon"
+    if distance is not None:
+        title += f" at {distance:.0f} m"
+    fig.update_layout(
+        title=title,
+        width=800,
+        height=700,
+        template='plotly_dark',
+        yaxis=dict(autorange='reversed'),
+    )
+    return fig
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Export the pairwise duel win-margin tensor for a loadout")
+    parser.add_argument("weapons", help="weapon data JSON, e.g. from `truegamedata.py -o`")
+    parser.add_argument("-o", "--output", default="duel.npz")
+    utils.add_cli_arguments(parser)
+    parser.add_argument("--ads", action="store_true", help="add ADS time to TTK")
+    args = parser.parse_args()
+    with open(args.weapons, 'r') as f:
+        weapons = json.load(f)
+    for wpn in weapons:
+        wpn.setdefault('spread', tuple(args.spread))
+    distances = utils.get_cli_distances(args.max_distance)
+    analysis = utils.analyze(weapons, distances, utils.AIM_CENTER_DICT[args.aim_center], ads=args.ads,
+                             target=args.target, hp=args.hp, aim_error=args.aim_error)
+    np.savez(args.output, guns=np.array(analysis.guns), distances=distances,
+             margins=get_results_margins(analysis))
+    print(f"Wrote {args.output}")
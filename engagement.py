@@ -0,0 +1,211 @@
+"""
+Multi-enemy engagements on one magazine budget.
+
+A squad fight is scheduled as follows: the first shot on each enemy is aimed and
+hits the region under the aim center (the free hit of `utils.apply_damage`), the
+following shots land according to the beam hit probabilities, and after each
+kill the shooter waits for the bullet to land and switches to the next enemy.
+The shooter starts on a full magazine, rounds left over carry to the next enemy,
+and a reload happens whenever the magazine runs dry. All enemies of a scenario
+stand at the same distance.
+
+Enemies are independent, so instead of simulating one shot at a time the engine
+computes the exact shots-to-kill distribution of one enemy with a dynamic
+program over damage taken, the distribution of the total shot count for n
+enemies as its n-fold convolution, and the time-to-clear of every shot count in
+closed form. Time is increasing in the shot count, so the time-to-clear
+distribution is the shot count distribution with times attached. Batch export:
+
+    python engagement.py weapons.json -n 1 2 3 4 -o engagement.npz
+"""
+import json
+from argparse import ArgumentParser
+
+import numpy as np
+
+import hitboxes
+import utils
+
+
+DEFAULT_ENEMIES = (1, 2, 3, 4)
+DEFAULT_SWITCH_TIME = 0.3                   # seconds to acquire the next enemy after a kill
+DEFAULT_QUANTILES = (0.1, 0.5, 0.9)
+MAX_SHOTS_PER_ENEMY = 512
+# Stop following a beam in the shots-to-kill recursion once its enemy is alive with less probability than this
+TAIL_TOLERANCE = 1e-9
+
+
+def get_shots_to_kill_pmf(probs, region_dmg, free_hit, hp, max_shots=MAX_SHOTS_PER_ENEMY, tol=TAIL_TOLERANCE):
+    """
+    Exact distribution of the number of shots to kill one enemy, for beams sharing one set of damage values
+
+    Damage is counted in whole hit points. Because the damage values are shared, every
+    outcome of a shot moves the distribution of damage taken by a fixed offset, so each
+    shot costs a few array slices regardless of the number of beams.
+
+    :param probs: array (beam, regions) of region hit probabilities; the remainder is a miss
+    :param region_dmg: damage of each region
+    :param free_hit: damage of the aimed first shot
+    :param hp: target hp
+    :param max_shots: longest kill considered; mass that needs more shots is dropped
+    :param tol: stop following a beam once its enemy is alive with less than this probability
+    :return: array (beam, max_shots + 1) whose entry k is the probability that the k-th shot kills
+    """
+    probs = np.asarray(probs, dtype=float)
+    hp = int(np.ceil(hp))
+    region_dmg = np.rint(region_dmg).astype(int)
+    free_hit = int(np.rint(free_hit))
+    pmf = np.zeros((len(probs), max_shots + 1))
+    if free_hit >= hp:
+        pmf[:, 1] = 1
+        return pmf
+    # alive[b, h]: probability that the enemy of beam rows[b] is alive with h damage taken
+    rows = np.arange(len(probs))
+    alive = np.zeros((len(probs), hp))
+    alive[:, max(free_hit, 0)] = 1
+    p_miss = np.clip(1 - probs.sum(axis=1), 0, 1)
+    for k in range(2, max_shots + 1):
+        new = alive * p_miss[:, None]
+        for r, dmg in enumerate(region_dmg):
+            if dmg <= 0:
+                new += alive * probs[:, r, None]
+                continue
+            # Enemies with at least hp - dmg damage taken die from this hit
+            pmf[rows, k] += alive[:, max(hp - dmg, 0):].sum(axis=1) * probs[:, r]
+            if dmg < hp:
+                new[:, dmg:] += alive[:, :hp - dmg] * probs[:, r, None]
+        alive = new
+        # Short distances finish long before far ones, so drop beams as soon as they are done
+        left = alive.sum(axis=1) >= tol
+        if not left.all():
+            rows, alive, probs, p_miss = rows[left], alive[left], probs[left], p_miss[left]
+            if len(rows) == 0:
+                break
+    return pmf
+
+
+def get_total_shots_pmf(shots_pmf, enemies):
+    """
+    Distribution of the total number of shots to kill several independent enemies
+
+    The n-fold convolution is a power of the Fourier transform, so every enemy count
+    comes out of one transform (padded to a power of two, which keeps it fast);
+    round-off below 1e-15 is clipped.
+
+    :param shots_pmf: array (..., shots) from `get_shots_to_kill_pmf`
+    :param enemies: enemy counts
+    :return: array (..., enemies, total shots)
+    """
+    enemies = np.asarray(enemies, dtype=int)
+    length = enemies.max() * (shots_pmf.shape[-1] - 1) + 1
+    fft_length = 2 ** int(np.ceil(np.log2(length)))
+    spectrum = np.fft.rfft(shots_pmf, n=fft_length, axis=-1)[..., None, :]
+    out = np.fft.irfft(spectrum ** enemies[:, None], n=fft_length, axis=-1)[..., :length]
+    out[out < 1e-15] = 0
+    return out
+
+
+def get_clear_times(wpn, distances, enemies, num_shots, switch_time=DEFAULT_SWITCH_TIME):
+    """
+    Time to clear `n` enemies with `s` shots in total, starting on a full magazine
+
+    :param wpn: weapon data dict
+    :param distances: array of distances in meters
+    :param enemies: enemy counts
+    :param num_shots: length of the total shots axis
+    :param switch_time: seconds to acquire the next enemy after a kill
+    :return: array (distance, enemies, total shots) of times in seconds
+    """
+    distances = np.asarray(distances, dtype=float)[:, None, None]
+    n = np.asarray(enemies, dtype=float)[:, None]
+    s = np.arange(num_shots)
+    t_travel = distances / wpn['bullet_velocity']
+    t_fire = np.maximum(s - n, 0) / (wpn['fire_rate'] / 60.)
+    t_reload = wpn['reload_time'] * np.floor(np.maximum(s - 1, 0) / wpn['mag_size'])
+    return t_fire + t_reload + n * t_travel + (n - 1) * switch_time
+
+
+def simulate(weapons, distances, center, enemies=DEFAULT_ENEMIES, target=hitboxes.DEFAULT_HITBOX,
+             hp=utils.DEFAULT_TARGET_HP, aim_error=None, lookup_table=None, switch_time=DEFAULT_SWITCH_TIME,
+             quantiles=DEFAULT_QUANTILES, max_shots=MAX_SHOTS_PER_ENEMY):
+    """
+    Time-to-clear distributions for every weapon, distance and enemy count
+
+    :param weapons: list of weapon data dicts with 'spread' entries
+    :param distances: array of distances in meters
+    :param center: aim center offset in meters
+    :param enemies: enemy counts
+    :param target: name of a registered hitbox model or hitbox array
+    :param hp: hp of each enemy
+    :param aim_error: optional (horizontal, vertical) aim jitter in meters
+    :param lookup_table: optional lookup table, see `utils.setup_beam_model`
+    :param switch_time: seconds to acquire the next enemy after a kill
+    :param quantiles: quantiles of the time-to-clear to report
+    :param max_shots: longest kill considered per enemy
+    :return: dict with 'guns', 'distances', 'enemies', 'quantile_levels', the distributions 'pmf' and their
+        'times' (weapon, distance, enemies, total shots), the probability 'cleared' of needing at most
+        `max_shots` per enemy, the 'mean' time-to-clear given that, both (weapon, distance, enemies), and
+        'quantiles' (quantile, weapon, distance, enemies), inf where a quantile is not reached
+    """
+    distances = np.asarray(distances, dtype=float)
+    enemies = np.asarray(enemies, dtype=int)
+    if len(enemies) == 0 or enemies.min() < 1:
+        raise ValueError("Enemy counts must be at least 1")
+    model = utils.setup_beam_model(center, target=target, lookup_table=lookup_table, aim_error=aim_error)
+    shots_pmf = np.zeros((len(weapons), len(distances), max_shots + 1))
+    for w, wpn in enumerate(weapons):
+        probs = utils.get_beam_probabilities(model, wpn['spread'], distances)
+        damage_profile = wpn['damage_profile']
+        edges = [d['dropoff'] for d in damage_profile] + [np.inf]
+        for i, segment in enumerate(damage_profile):
+            idx = np.flatnonzero((distances >= edges[i]) & (distances < edges[i + 1]))
+            if len(idx) > 0:
+                shots_pmf[w, idx] = get_shots_to_kill_pmf(
+                    probs[idx], [segment[k] for k in model['regions']], segment[model['center_region']], hp,
+                    max_shots=max_shots)
+    # Drop shot counts beyond the longest possible kill before convolving
+    last = np.flatnonzero(shots_pmf.reshape(-1, max_shots + 1).any(axis=0))
+    shots_pmf = shots_pmf[..., :(last[-1] + 1 if len(last) else 2)]
+    pmf = get_total_shots_pmf(shots_pmf, enemies)
+    times = np.stack([get_clear_times(wpn, distances, enemies, pmf.shape[-1], switch_time=switch_time)
+                      for wpn in weapons]) if weapons else np.zeros(pmf.shape)
+    cleared = pmf.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (pmf * times).sum(axis=-1) / cleared
+    cdf = np.cumsum(pmf, axis=-1)
+    out_quantiles = np.full((len(quantiles),) + cleared.shape, np.inf)
+    for i, q in enumerate(quantiles):
+        reached = cdf[..., -1] >= q
+        idx = np.argmax(cdf >= q, axis=-1)
+        out_quantiles[i][reached] = np.take_along_axis(times, idx[..., None], axis=-1)[..., 0][reached]
+    return dict(
+        guns=[wpn['gun'] for wpn in weapons],
+        distances=distances,
+        enemies=enemies,
+        quantile_levels=np.asarray(quantiles, dtype=float),
+        pmf=pmf,
+        times=times,
+        cleared=cleared,
+        mean=mean,
+        quantiles=out_quantiles,
+    )
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Export time-to-clear distributions of multi-enemy engagements")
+    parser.add_argument("weapons", help="weapon data JSON, e.g. from `truegamedata.py -o`")
+    parser.add_argument("-o", "--output", default="engagement.npz")
+    parser.add_argument("-n", "--enemies", nargs='+', type=int, default=list(DEFAULT_ENEMIES))
+    utils.add_cli_arguments(parser)
+    parser.add_argument("--switch-time", type=float, default=DEFAULT_SWITCH_TIME)
+    args = parser.parse_args()
+    with open(args.weapons, 'r') as f:
+        weapons = json.load(f)
+    for wpn in weapons:
+        wpn.setdefault('spread', tuple(args.spread))
+    result = simulate(weapons, utils.get_cli_distances(args.max_distance),
+                      utils.AIM_CENTER_DICT[args.aim_center], enemies=args.enemies, target=args.target, hp=args.hp,
+                      aim_error=args.aim_error, switch_time=args.switch_time)
+    np.savez(args.output, guns=np.array(result['guns']),
+             **{k: v for k, v in result.items() if k != 'guns'})
+    print(f"Wrote {args.output}")
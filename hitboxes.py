@@ -0,0 +1,184 @@
+"""
+Registry of hitbox models and their derived artifacts.
+
+Each model is a grayscale image with the hitbox regions painted in, plus the
+scale and region-color metadata needed to use it. Derived artifacts (region
+rectangles, the region probability lookup table) are built once into a cache
+directory named after a hash of the model content, so every process loads them
+lazily instead of recomputing them. Build everything ahead of time with:
+
+    python hitboxes.py
+"""
+import hashlib
+import json
+import os
+import threading
+from argparse import ArgumentParser
+
+import numpy as np
+
+
+# Bump whenever the layout of the cached artifacts changes
+ARTIFACTS_VERSION = 2
+DEFAULT_CACHE_DIR = os.path.join('.cache', 'hitboxes')
+
+HITBOXES = {
+    'cod1': dict(
+        label="Standing",
+        # Hitbox was generated externally with photoshop and some down-sampling
+        filepath='hitbox_cod1.npy',
+        height_pixels=404,      # pixel height of hitbox
+        height_meters=1.8,      # estimated physical height, about 6 ft
+        # The "regions" are painted in with the following grayscale colors:
+        regions={'head': 255, 'chest': 207, 'stomach': 126, 'extremities': 71, 'miss': 0},
+    ),
+}
+DEFAULT_HITBOX = 'cod1'
+
+
+class Hitbox:
+    """
+    Hitbox model with lazily loaded, disk-cached derived artifacts
+    """
+
+    def __init__(self, name, filepath, height_pixels, height_meters, regions, label=None,
+                 cache_dir=DEFAULT_CACHE_DIR):
+        self.name = name
+        self.label = label or name
+        self.filepath = filepath
+        self.height_pixels = height_pixels
+        self.height_meters = height_meters
+        self.regions = regions
+        self.im_scale = height_pixels / height_meters
+        self.cache_dir = cache_dir
+        self._lock = threading.RLock()
+        self._target = None
+        self._key = None
+        self._rectangles = None
+        self._lookup_table = None
+
+    @property
+    def target(self):
+        """Hit-box array transposed so that rows -> X values and columns -> Y values"""
+        with self._lock:
+            if self._target is None:
+                self._target = np.load(self.filepath)[::-1].T
+            return self._target
+
+    @property
+    def key(self):
+        """Hash of everything the derived artifacts depend on"""
+        with self._lock:
+            if self._key is None:
+                import utils
+                import lookup
+                h = hashlib.sha256()
+                with open(self.filepath, 'rb') as f:
+                    h.update(f.read())
+                h.update(json.dumps(dict(
+                    height_pixels=self.height_pixels,
+                    height_meters=self.height_meters,
+                    regions=self.regions,
+                    centers=sorted(utils.AIM_CENTER_DICT.values()),
+                    artifacts_version=ARTIFACTS_VERSION,
+                    lookup_version=lookup.LOOKUP_TABLE_VERSION,
+                ), sort_keys=True).encode())
+                self._key = h.hexdigest()[:16]
+            return self._key
+
+    @property
+    def cache_path(self):
+        return os.path.join(self.cache_dir, f"{self.name}-{self.key}")
+
+    def _artifact_path(self, filename):
+        return os.path.join(self.cache_path, filename)
+
+    def _save_artifact(self, filename, save):
+        os.makedirs(self.cache_path, exist_ok=True)
+        path = self._artifact_path(filename)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            save(f)
+        os.replace(tmp_path, path)  # atomic, so other processes never see a partial file
+
+    @property
+    def rectangles(self):
+        """Region names and the rectangle decomposition of every region except 'miss', see
+        `utils.get_region_rectangles`"""
+        with self._lock:
+            if self._rectangles is None:
+                path = self._artifact_path('rectangles.npz')
+                if os.path.exists(path):
+                    with np.load(path) as f:
+                        self._rectangles = (list(f['regions']), f['rectangles'])
+                else:
+                    import utils
+                    regions, rectangles = utils.get_region_rectangles(target=self.target,
+                                                                      target_regions=self.regions)
+                    self._save_artifact(
+                        'rectangles.npz',
+                        lambda f: np.savez_compressed(f, regions=np.array(regions), rectangles=rectangles)
+                    )
+                    self._rectangles = (regions, rectangles)
+            return self._rectangles
+
+    def get_lookup_table(self, build=False):
+        """
+        Region probability lookup table for this hitbox
+
+        :param build: build and cache the table if it does not exist yet (takes a few seconds)
+        :return: lookup table dict, or None if it is not built and `build` is False
+        """
+        with self._lock:
+            if self._lookup_table is None:
+                import utils
+                import lookup
+                path = self._artifact_path('lut.npz')
+                if os.path.exists(path):
+                    self._lookup_table = lookup.load_lookup_table(path)
+                elif build:
+                    table = lookup.build_lookup_table(
+                        list(utils.AIM_CENTER_DICT.values()),
+                        target=self.target,
+                        target_regions=self.regions,
+                        im_scale=self.im_scale,
+                        region_rectangles=self.rectangles,
+                    )
+                    self._save_artifact('lut.npz', lambda f: lookup.save_lookup_table(table, f))
+                    self._lookup_table = table
+            return self._lookup_table
+
+    def build(self):
+        """Build all derived artifacts"""
+        self.rectangles
+        self.get_lookup_table(build=True)
+
+
+_hitboxes = {}
+_hitboxes_lock = threading.Lock()
+
+
+def get_hitbox(name=DEFAULT_HITBOX):
+    """
+    Get a registered hitbox model, shared within the process
+
+    :param name: key of HITBOXES
+    :return: Hitbox
+    """
+    with _hitboxes_lock:
+        if name not in _hitboxes:
+            if name not in HITBOXES:
+                raise KeyError(f"Unknown hitbox model '{name}', expected one of {list(HITBOXES.keys())}")
+            _hitboxes[name] = Hitbox(name, **HITBOXES[name])
+        return _hitboxes[name]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Build derived artifacts for registered hitbox models")
+    parser.add_argument("names", nargs='*', default=list(HITBOXES.keys()))
+    args = parser.parse_args()
+    for hitbox_name in args.names:
+        hitbox = get_hitbox(hitbox_name)
+        hitbox.build()
+        print(f"{hitbox_name}: {hitbox.cache_path} "
+              f"(max interpolation error {hitbox.get_lookup_table()['max_error']:.2e})")
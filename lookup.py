@@ -0,0 +1,165 @@
+"""
+Precomputed region hit probabilities for the Gaussian beam model.
+
+The beam footprint on the target only depends on the aim center and on the
+linear beam sigma in meters (angular spread x distance / BEAM_GAUSSIAN_SCALE),
+so the hit probability of every hitbox region can be tabulated once per aim
+center over a 2-D grid of horizontal and vertical sigma. Queries interpolate
+bilinearly in log(sigma) and never touch the hitbox pixels.
+
+Tables of registered hitbox models are built into the hitbox artifact cache
+(`.cache/hitboxes/<model>-<content hash>/lut.npz`), where the app reads them:
+
+    python hitboxes.py
+
+The worst-case interpolation error (absolute, in hit probability) is measured
+at build time by evaluating the exact model halfway between grid nodes; it is
+stored in the table as `max_error` and printed by the build command. With the
+default 64 x 64 grid it is about 2e-3.
+"""
+import numpy as np
+
+import utils
+
+
+# Bump whenever the beam model or the table layout changes
+LOOKUP_TABLE_VERSION = 3
+
+# Linear beam sigma grid in meters. App sliders go from 0.05 deg at 10 m
+# (~0.003 m) up to 2.51 deg at 150 m (~2.2 m).
+DEFAULT_SIGMA_RANGE = (0.002, 4.0)
+DEFAULT_GRID_SIZE = 64
+
+
+def get_linear_sigma(spread, distance, gaussian_scale=utils.BEAM_GAUSSIAN_SCALE, aim_error=None):
+    """
+    Convert angular spread (degrees) at a given distance into linear beam sigma in meters
+
+    :param spread: (horizontal, vertical) spread in degrees
+    :param distance: distance(s) in meters
+    :param gaussian_scale: beam box width in units of sigma
+    :param aim_error: optional (horizontal, vertical) aim jitter in meters, see `utils.get_beam_box`
+    :return: (horizontal, vertical) sigma in meters
+    """
+    distance = np.asarray(distance, dtype=float)
+    sigma_x = spread[0] * (np.pi / 180.) * distance / gaussian_scale
+    sigma_y = spread[1] * (np.pi / 180.) * distance / gaussian_scale
+    if aim_error is not None:
+        sigma_x = np.sqrt(sigma_x ** 2 + 2 * aim_error[0] ** 2)
+        sigma_y = np.sqrt(sigma_y ** 2 + 2 * aim_error[1] ** 2)
+    return sigma_x, sigma_y
+
+
+def _region_probabilities_grid(center, sigmas_x, sigmas_y, rectangles, num_regions, target, im_scale):
+    center_pix = utils.get_aim_center(center, target=target, im_scale=im_scale)
+    sigma_x, sigma_y = np.meshgrid(sigmas_x, sigmas_y, indexing='ij')
+    return utils.get_rectangle_probabilities(center_pix, (sigma_x * im_scale, sigma_y * im_scale), rectangles,
+                                             num_regions)
+
+
+def build_lookup_table(centers, sigma_range=DEFAULT_SIGMA_RANGE, grid_size=DEFAULT_GRID_SIZE,
+                       target=utils.TARGET, target_regions=utils.TARGET_REGIONS, im_scale=utils.IM_SCALE,
+                       region_rectangles=None):
+    """
+    Tabulate region hit probabilities over a log-spaced grid of linear beam sigma
+
+    :param centers: list of aim center offsets in meters
+    :param sigma_range: (min, max) linear sigma in meters
+    :param grid_size: number of grid nodes per axis
+    :param target: hitbox array
+    :param target_regions: hitbox region colors
+    :param im_scale: pixels per meter
+    :param region_rectangles: optional precomputed (regions, rectangles) from `utils.get_region_rectangles`
+    :return: dict with the table arrays
+    """
+    if region_rectangles is None:
+        region_rectangles = utils.get_region_rectangles(target=target, target_regions=target_regions)
+    regions, rectangles = region_rectangles
+    log_sigmas = np.linspace(np.log(sigma_range[0]), np.log(sigma_range[1]), grid_size)
+    sigmas = np.exp(log_sigmas)
+    mid_sigmas = np.exp((log_sigmas[1:] + log_sigmas[:-1]) / 2)
+    probs = np.zeros((len(centers), grid_size, grid_size, len(regions)))
+    max_error = 0.
+    table = dict(
+        version=LOOKUP_TABLE_VERSION,
+        centers=np.asarray(centers, dtype=float),
+        sigmas=sigmas,
+        regions=np.array(regions),
+        probs=probs,
+    )
+    for k, center in enumerate(centers):
+        probs[k] = _region_probabilities_grid(center, sigmas, sigmas, rectangles, len(regions), target, im_scale)
+        exact = _region_probabilities_grid(center, mid_sigmas, mid_sigmas, rectangles, len(regions), target,
+                                           im_scale)
+        sigma_x, sigma_y = np.meshgrid(mid_sigmas, mid_sigmas, indexing='ij')
+        approx = query_region_probabilities(table, center, (sigma_x.ravel(), sigma_y.ravel()))
+        max_error = max(max_error, np.abs(approx - exact.reshape(approx.shape)).max())
+    table['max_error'] = max_error
+    return table
+
+
+def save_lookup_table(table, filepath):
+    np.savez_compressed(filepath, **table)
+
+
+def load_lookup_table(filepath):
+    with np.load(filepath) as f:
+        table = {k: f[k] for k in f.files}
+    if int(table['version']) != LOOKUP_TABLE_VERSION:
+        raise ValueError(
+            f"Lookup table {filepath} has version {int(table['version'])}, expected {LOOKUP_TABLE_VERSION}; "
+            "rebuild it with `python hitboxes.py`"
+        )
+    return table
+
+
+def get_center_index(table, center):
+    """
+    :param table: lookup table
+    :param center: aim center offset in meters
+    :return: index of the center in the table, or None if it is not tabulated
+    """
+    matches = np.flatnonzero(np.all(np.isclose(table['centers'], center), axis=1))
+    return int(matches[0]) if len(matches) > 0 else None
+
+
+def covers_sigma(table, sigma):
+    """
+    :param table: lookup table
+    :param sigma: (horizontal, vertical) linear sigma in meters, scalars or arrays of equal shape
+    :return: True if every sigma lies inside the tabulated range
+    """
+    sigmas = table['sigmas']
+    sigma = np.asarray(sigma, dtype=float)
+    return bool(np.all((sigma >= sigmas[0] * (1 - 1e-9)) & (sigma <= sigmas[-1] * (1 + 1e-9))))
+
+
+def query_region_probabilities(table, center, sigma):
+    """
+    Interpolate region hit probabilities from a lookup table
+
+    :param table: table from `build_lookup_table` or `load_lookup_table`
+    :param center: aim center offset in meters, must be one of the tabulated centers
+    :param sigma: (horizontal, vertical) linear sigma in meters, scalars or arrays of equal shape
+    :return: array of hit probabilities (..., regions)
+    """
+    index = get_center_index(table, center)
+    if index is None:
+        raise ValueError(f"Aim center {tuple(center)} is not in the lookup table")
+    if not covers_sigma(table, sigma):
+        raise ValueError("Beam sigma is outside of the lookup table range")
+    probs = table['probs'][index]
+    log_sigmas = np.log(table['sigmas'])
+    log_x = np.log(np.asarray(sigma[0], dtype=float))
+    log_y = np.log(np.asarray(sigma[1], dtype=float))
+    ix = np.clip(np.searchsorted(log_sigmas, log_x) - 1, 0, len(log_sigmas) - 2)
+    iy = np.clip(np.searchsorted(log_sigmas, log_y) - 1, 0, len(log_sigmas) - 2)
+    step = log_sigmas[1] - log_sigmas[0]
+    wx = np.clip((log_x - log_sigmas[ix]) / step, 0, 1)[..., None]
+    wy = np.clip((log_y - log_sigmas[iy]) / step, 0, 1)[..., None]
+    return (
+        probs[ix, iy] * (1 - wx) * (1 - wy)
+        + probs[ix + 1, iy] * wx * (1 - wy)
+        + probs[ix, iy + 1] * (1 - wx) * wy
+        + probs[ix + 1, iy + 1] * wx * wy
+    )
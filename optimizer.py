@@ -0,0 +1,205 @@
+"""
+Attachment and stat optimizer for minimum time-to-kill.
+
+Attachments trade a weapon's stats against each other (fire rate, range
+modifier, bullet velocity, ADS time, reload time, magazine size) but leave its
+recoil spread alone, so the beam hit probabilities only depend on distance. They
+are computed once per weapon and reused by every build, and the whole grid of
+builds goes through `utils.apply_damage` in one broadcast. The result is the
+Pareto front of mean TTK at the chosen distances against ADS time. Batch use:
+
+    python optimizer.py example.json -g "Kilo 141" -a attachments.json -d 25 50
+    python optimizer.py example.json -g "Kilo 141" -r fire_rate 700 800 5 -r ads 350 450 5
+
+Attachment files map slot names to attachments and their stat deltas, e.g.
+{"Muzzle": {"Monolithic Suppressor": {"range_modifier": 0.15, "ads": 40}}}.
+"""
+import json
+from argparse import ArgumentParser
+
+import numpy as np
+
+import hitboxes
+import utils
+
+
+# Stats a build can change, in weapon data units (rounds per minute, fraction, m/s, ms, s, rounds)
+STATS = ('fire_rate', 'range_modifier', 'bullet_velocity', 'ads', 'reload_time', 'mag_size')
+MAX_ATTACHMENTS = 5
+MAX_BUILDS = 10 ** 6
+
+
+def get_base_stats(wpn):
+    """
+    :param wpn: weapon data dict
+    :return: dict of stat name -> float for every stat in STATS
+    """
+    missing = [k for k in STATS if k != 'range_modifier' and k not in wpn]
+    if missing:
+        raise ValueError(f"Weapon is missing {', '.join(missing)}")
+    return {k: float(wpn.get(k) or 0.) for k in STATS}
+
+
+def get_stat_grid(wpn, candidates):
+    """
+    Builds for every combination of candidate stat values
+
+    :param wpn: weapon data dict
+    :param candidates: dict of stat name -> candidate values; other stats keep the weapon's value
+    :return: dict of stat name -> array (build,), list of build labels
+    """
+    unknown = set(candidates) - set(STATS)
+    if unknown:
+        raise ValueError(f"Unknown stats {sorted(unknown)}, expected some of {STATS}")
+    names = list(candidates)
+    values = [np.atleast_1d(np.asarray(candidates[k], dtype=float)) for k in names]
+    if np.prod([len(v) for v in values]) > MAX_BUILDS:
+        raise ValueError(f"Stat grid has more than {MAX_BUILDS} builds")
+    grids = [g.ravel() for g in np.meshgrid(*values, indexing='ij')]
+    num_builds = len(grids[0]) if grids else 1
+    stats = {k: np.full(num_builds, v) for k, v in get_base_stats(wpn).items()}
+    stats.update(zip(names, grids))
+    labels = [', '.join(f"{k}={stats[k][b]:g}" for k in names) for b in range(num_builds)]
+    return stats, labels
+
+
+def get_attachment_builds(wpn, slots, max_attachments=MAX_ATTACHMENTS):
+    """
+    Builds for every combination of at most one attachment per slot
+
+    :param wpn: weapon data dict
+    :param slots: dict of slot name -> dict of attachment name -> dict of stat deltas
+    :param max_attachments: maximum number of slots in use
+    :return: dict of stat name -> array (build,), list of build labels
+    """
+    options = [[None] + list(attachments) for attachments in slots.values()]
+    deltas = []
+    for attachments in slots.values():
+        unknown = {k for d in attachments.values() for k in d} - set(STATS)
+        if unknown:
+            raise ValueError(f"Unknown stats {sorted(unknown)}, expected some of {STATS}")
+        deltas.append(np.array([[0.] * len(STATS)]
+                               + [[d.get(k, 0.) for k in STATS] for d in attachments.values()]))
+    if np.prod([len(o) for o in options]) > MAX_BUILDS:
+        raise ValueError(f"Attachments have more than {MAX_BUILDS} combinations")
+    choices = np.stack([g.ravel() for g in np.meshgrid(*[np.arange(len(o)) for o in options], indexing='ij')],
+                       axis=-1).reshape(-1, len(options))
+    choices = choices[(choices > 0).sum(axis=1) <= max_attachments]
+    base = np.array([get_base_stats(wpn)[k] for k in STATS])
+    total = base + sum(d[choices[:, s]] for s, d in enumerate(deltas))
+    stats = {k: np.ascontiguousarray(total[:, i]) for i, k in enumerate(STATS)}
+    labels = [' + '.join(o[c] for o, c in zip(options, row) if c > 0) or "No attachments" for row in choices]
+    return stats, labels
+
+
+def evaluate_builds(wpn, stats, distances, center, target=hitboxes.DEFAULT_HITBOX, hp=utils.DEFAULT_TARGET_HP,
+                    aim_error=None, lookup_table=None):
+    """
+    TTK of every build at every distance in one broadcast
+
+    :param wpn: weapon data dict with a 'spread' entry, whose dropoffs include its range modifier
+    :param stats: dict of stat name -> array (build,), see `get_stat_grid` and `get_attachment_builds`
+    :param distances: array of distances in meters
+    :param center: aim center offset in meters
+    :param target: name of a registered hitbox model or hitbox array
+    :param hp: target hp
+    :param aim_error: optional (horizontal, vertical) aim jitter in meters
+    :param lookup_table: optional lookup table, see `utils.setup_beam_model`
+    :return: array (build, distance) of recoil-adjusted TTK in seconds, without ADS time
+    """
+    for k in ('fire_rate', 'bullet_velocity', 'mag_size'):
+        if np.any(stats[k] <= 0):
+            raise ValueError(f"Every build needs a positive {k}")
+    if np.any(stats['range_modifier'] <= -1):
+        raise ValueError("Every build needs a range modifier above -1")
+    distances = np.atleast_1d(np.asarray(distances, dtype=float))
+    model = utils.setup_beam_model(center, target=target, lookup_table=lookup_table, aim_error=aim_error)
+    # Builds share the spread, so the beam is evaluated once for all of them
+    probs = utils.get_beam_probabilities(model, wpn['spread'], distances)
+    damage_profile = wpn['damage_profile']
+    region_dmg = np.array([[d[k] for k in model['regions']] for d in damage_profile], dtype=float)
+    segment_dpr = probs @ region_dmg.T
+    segment_free_hit = np.array([d[model['center_region']] for d in damage_profile], dtype=float)
+    # Dropoffs scale with 1 + range modifier, see truegamedata.get_weapons_data
+    base_dropoffs = np.array([d['dropoff'] for d in damage_profile]) / (1 + get_base_stats(wpn)['range_modifier'])
+    dropoffs = base_dropoffs[None, :] * (1 + stats['range_modifier'])[:, None]
+    segment = np.maximum((dropoffs[:, None, :] <= distances[None, :, None]).sum(axis=-1) - 1, 0)
+    dpr = segment_dpr[np.arange(len(distances))[None, :], segment]
+    builds = {k: v[:, None] for k, v in stats.items()}
+    _, _, ttk = utils.apply_damage(dpr, distances[None, :], builds, hp=hp, free_hit=segment_free_hit[segment])
+    return ttk
+
+
+def get_pareto_front(ttk, ads):
+    """
+    Builds that no other build beats on both TTK and ADS time; of builds tied on both, only one is kept
+
+    :param ttk: array (build,) of TTK scores
+    :param ads: array (build,) of ADS times
+    :return: indices of the front, in order of increasing ADS time (and decreasing TTK)
+    """
+    order = np.lexsort((ttk, ads))
+    ttk_sorted = ttk[order]
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = ttk_sorted[1:] < np.minimum.accumulate(ttk_sorted)[:-1]
+    return order[keep]
+
+
+def optimize(wpn, stats, labels, distances, center, target=hitboxes.DEFAULT_HITBOX, hp=utils.DEFAULT_TARGET_HP,
+             aim_error=None, lookup_table=None):
+    """
+    Pareto front of mean TTK at `distances` against ADS time
+
+    :param wpn: weapon data dict with a 'spread' entry
+    :param stats: dict of stat name -> array (build,)
+    :param labels: list of build labels
+    :param distances: distances in meters at which TTK is scored
+    :return: dict with the build 'labels', 'stats', 'distances', 'ttk' (build, distance), mean TTK 'score'
+        and the indices of the Pareto 'front'
+    """
+    ttk = evaluate_builds(wpn, stats, distances, center, target=target, hp=hp, aim_error=aim_error,
+                          lookup_table=lookup_table)
+    score = ttk.mean(axis=1)
+    return dict(
+        labels=labels,
+        stats=stats,
+        distances=np.atleast_1d(np.asarray(distances, dtype=float)),
+        ttk=ttk,
+        score=score,
+        front=get_pareto_front(score, stats['ads']),
+    )
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Pareto front of TTK versus ADS time over attachment builds")
+    parser.add_argument("weapons", help="weapon data JSON, e.g. from `truegamedata.py -o`")
+    parser.add_argument("-g", "--gun", help="weapon to optimize, defaults to the first one")
+    parser.add_argument("-a", "--attachments", help="JSON of slot -> attachment -> stat deltas")
+    parser.add_argument("-r", "--range", nargs=4, action='append', default=[], metavar=('STAT', 'MIN', 'MAX', 'NUM'),
+                        help="candidate values for a stat, instead of attachments")
+    parser.add_argument("-m", "--max-attachments", type=int, default=MAX_ATTACHMENTS)
+    parser.add_argument("-d", "--distances", nargs='+', type=float, default=[25., 50.])
+    utils.add_cli_arguments(parser, max_distance=False, aim_error_flags=("--aim-error",))
+    args = parser.parse_args()
+    with open(args.weapons, 'r') as f:
+        weapons = json.load(f)
+    if args.gun is not None:
+        weapons = [wpn for wpn in weapons if wpn['gun'] == args.gun]
+        if not weapons:
+            parser.error(f"No weapon named '{args.gun}'")
+    weapon = weapons[0]
+    weapon.setdefault('spread', tuple(args.spread))
+    if args.attachments is not None:
+        with open(args.attachments, 'r') as f:
+            build_stats, build_labels = get_attachment_builds(weapon, json.load(f),
+                                                              max_attachments=args.max_attachments)
+    else:
+        build_stats, build_labels = get_stat_grid(weapon, {
+            stat: np.linspace(float(lo), float(hi), int(num)) for stat, lo, hi, num in args.range
+        })
+    result = optimize(weapon, build_stats, build_labels, args.distances, utils.AIM_CENTER_DICT[args.aim_center],
+                      target=args.target, hp=args.hp, aim_error=args.aim_error)
+    print(f"{weapon['gun']}: {len(build_labels)} builds, {len(result['front'])} on the Pareto front")
+    print("ADS [ms]\tTTK [s]\tBuild")
+    for b in result['front']:
+        print(f"{build_stats['ads'][b]:.0f}\t{result['score'][b]:.3f}\t{build_labels[b]}")
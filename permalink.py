@@ -0,0 +1,180 @@
+"""
+Compact shareable permalinks.
+
+A permalink token packs everything needed to reproduce a performance plot (the
+loadout stats, spreads, aim center and aim error, ADS and distance settings,
+and display options) into a URL-safe string: positional JSON, zlib-compressed and base64url
+encoded. Tokens are self-contained, so a link keeps working without a new
+TrueGameData fetch even after its cached results have been evicted. The server
+keeps computed results and figures in a size-bounded LRU store keyed by the
+content hash of the decoded state, so popular links load with no computation.
+
+Shared links use a short id instead ("?p=<id>", a content hash of the token),
+which a SQLite `LinkStore` resolves to its token for every worker process on the
+host. The self-contained "?s=<token>" link is handed out with it as a fallback
+for servers that do not know the id.
+"""
+import base64
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+import zlib
+
+from cache import LRUCache, make_key
+
+
+# Bump whenever the packed layout changes; older tokens are rejected
+PERMALINK_VERSION = 2
+MAX_TOKEN_LENGTH = 8192
+DEFAULT_STORE_ITEMS = 1024
+DEFAULT_STORE_BYTES = 64 * 2 ** 20
+DEFAULT_LINKS_FILEPATH = 'permalinks.db'
+LINK_ID_BYTES = 9                           # 12 URL characters
+
+# Packed field orders
+WEAPON_STATS = ('gun', 'fire_rate', 'range_modifier', 'ads', 'sprint_to_fire', 'tactical_sprint_to_fire',
+                'bullet_velocity', 'reload_time', 'mag_size')
+DAMAGE_FIELDS = ('head', 'chest', 'stomach', 'extremities', 'dropoff')
+REQUIRED_STATS = ('fire_rate', 'ads', 'bullet_velocity', 'reload_time', 'mag_size')
+POSITIVE_STATS = ('fire_rate', 'bullet_velocity', 'mag_size')
+SETTINGS = ('aim_center', 'ads', 'distance', 'target', 'hp', 'mode', 'x_mode', 'y_mode', 'show_nr', 'aim_error')
+
+
+def _pack_weapon(wpn):
+    stats = [wpn.get(k) for k in WEAPON_STATS]
+    damage = [[d[k] for k in DAMAGE_FIELDS] for d in wpn['damage_profile']]
+    return [stats, damage, list(wpn['spread'])]
+
+
+def _is_number(value, minimum=-math.inf):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and minimum <= value < math.inf
+
+
+def _unpack_weapon(packed):
+    stats, damage, spread = packed
+    if len(stats) != len(WEAPON_STATS) or len(spread) != 2 or not isinstance(stats[0], str):
+        raise ValueError("Malformed weapon in permalink")
+    wpn = {k: v for k, v in zip(WEAPON_STATS, stats) if v is not None}
+    # Tokens come from URLs, so every value the analysis reads is checked before it gets there
+    if not all(_is_number(v) for k, v in wpn.items() if k != 'gun'):
+        raise ValueError("Malformed weapon in permalink")
+    if any(k not in wpn for k in REQUIRED_STATS) or not all(wpn[k] > 0 for k in POSITIVE_STATS):
+        raise ValueError("Malformed weapon in permalink")
+    if not isinstance(damage, list) or len(damage) == 0:
+        raise ValueError("Malformed weapon in permalink")
+    for d in damage:
+        if len(d) != len(DAMAGE_FIELDS) or not all(_is_number(v, 0) for v in d):
+            raise ValueError("Malformed weapon in permalink")
+    wpn['damage_profile'] = [dict(zip(DAMAGE_FIELDS, d)) for d in damage]
+    if not all(_is_number(v) and v > 0 for v in spread):
+        raise ValueError("Malformed weapon in permalink")
+    wpn['spread'] = (float(spread[0]), float(spread[1]))
+    return wpn
+
+
+def encode_state(state):
+    """
+    Pack a plot state into a URL token
+
+    :param state: dict with a 'weapons' list (weapon data with 'spread' entries) and the SETTINGS keys
+    :return: str token
+    """
+    packed = [PERMALINK_VERSION, [_pack_weapon(wpn) for wpn in state['weapons']]]
+    packed.extend(state[k] for k in SETTINGS)
+    raw = json.dumps(packed, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(zlib.compress(raw, 9)).decode('ascii').rstrip('=')
+
+
+def decode_state(token):
+    """
+    Unpack a URL token from `encode_state`
+
+    :param token: str token
+    :return: state dict
+    :raises ValueError: if the token is malformed or from another version
+    """
+    if not token or len(token) > MAX_TOKEN_LENGTH:
+        raise ValueError("Invalid permalink")
+    try:
+        raw = zlib.decompress(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        packed = json.loads(raw)
+    except (ValueError, zlib.error):
+        raise ValueError("Invalid permalink")
+    if not isinstance(packed, list) or len(packed) != 2 + len(SETTINGS) or packed[0] != PERMALINK_VERSION:
+        raise ValueError("Invalid or outdated permalink")
+    try:
+        weapons = [_unpack_weapon(wpn) for wpn in packed[1]]
+    except (TypeError, KeyError, ValueError):
+        raise ValueError("Malformed weapon in permalink")
+    state = dict(zip(SETTINGS, packed[2:]))
+    state['weapons'] = weapons
+    return state
+
+
+def get_state_key(state):
+    """Content hash of a plot state, used as the result store key"""
+    return make_key(state)
+
+
+def get_entry_size(entry):
+    """Approximate size in bytes of a result store entry"""
+    return len(entry['results']['data']) + len(entry['figure'])
+
+
+def create_store(max_items=DEFAULT_STORE_ITEMS, max_bytes=DEFAULT_STORE_BYTES):
+    """
+    Result store for permalinks, holding dicts with the stored `AnalysisResults` ('results')
+    and the figure JSON ('figure')
+
+    :return: cache.LRUCache
+    """
+    return LRUCache(max_items=max_items, max_bytes=max_bytes, sizeof=get_entry_size)
+
+
+def get_link_id(token):
+    """
+    Short id of a token: URL-safe content hash
+
+    :param token: str token from `encode_state`
+    :return: str id
+    """
+    digest = hashlib.sha256(token.encode('ascii')).digest()[:LINK_ID_BYTES]
+    return base64.urlsafe_b64encode(digest).decode('ascii')
+
+
+class LinkStore:
+    """
+    Thread-safe SQLite map of short link ids to tokens, shared by the worker processes of a host
+    """
+
+    def __init__(self, filepath=DEFAULT_LINKS_FILEPATH):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filepath, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS links (id TEXT PRIMARY KEY, token TEXT NOT NULL)")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def put(self, token):
+        """
+        :param token: str token from `encode_state`
+        :return: short link id
+        """
+        link_id = get_link_id(token)
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO links (id, token) VALUES (?, ?)", (link_id, token))
+        return link_id
+
+    def get(self, link_id):
+        """
+        :param link_id: id from `put`
+        :return: token, or None if the id is unknown
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT token FROM links WHERE id = ?", (link_id,)).fetchone()
+        return None if row is None else row[0]
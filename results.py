@@ -0,0 +1,139 @@
+"""
+Columnar container for analysis results.
+"""
+import base64
+
+import numpy as np
+
+
+METRICS = ('dps', 'stk', 'ttk', 'dps_nr', 'stk_nr', 'ttk_nr')
+# Optional derivatives of DPS and TTK with respect to horizontal (x) and vertical (y) spread in degrees
+SENSITIVITY_METRICS = ('ddps_dx', 'ddps_dy', 'dttk_dx', 'dttk_dy')
+
+
+class AnalysisResults:
+    """
+    DPS, STK and TTK (with and without recoil) for a set of weapons.
+
+    All metrics live in one contiguous array of shape (metric, weapon, distance, hp)
+    and the named accessors return views into it. The metric axis holds METRICS,
+    followed by SENSITIVITY_METRICS if spread sensitivities were computed.
+    """
+    __slots__ = ('guns', 'distances', 'hp', 'metrics', 'data')
+
+    def __init__(self, guns, distances, hp, data=None, sensitivity=False):
+        self.guns = list(guns)
+        self.distances = np.asarray(distances, dtype=float)
+        self.hp = np.atleast_1d(np.asarray(hp, dtype=float))
+        self.metrics = METRICS + SENSITIVITY_METRICS if sensitivity else METRICS
+        shape = (len(self.metrics), len(self.guns), len(self.distances), len(self.hp))
+        if data is None:
+            data = np.zeros(shape)
+        elif data.shape != shape:
+            raise ValueError(f"Results data has shape {data.shape}, expected {shape}")
+        self.data = data
+
+    def metric(self, name):
+        """
+        :param name: one of `self.metrics`
+        :return: view of shape (weapon, distance, hp)
+        """
+        if name not in self.metrics:
+            raise KeyError(f"Unknown metric '{name}', expected one of {self.metrics}")
+        return self.data[self.metrics.index(name)]
+
+    @property
+    def sensitivity(self):
+        return self.metrics != METRICS
+
+    def get(self, name, gun):
+        """
+        :param name: one of `self.metrics`
+        :param gun: weapon name
+        :return: view of shape (distance, hp)
+        """
+        return self.metric(name)[self.guns.index(gun)]
+
+    @property
+    def dps(self):
+        return self.metric('dps')
+
+    @property
+    def stk(self):
+        return self.metric('stk')
+
+    @property
+    def ttk(self):
+        return self.metric('ttk')
+
+    @property
+    def dps_nr(self):
+        return self.metric('dps_nr')
+
+    @property
+    def stk_nr(self):
+        return self.metric('stk_nr')
+
+    @property
+    def ttk_nr(self):
+        return self.metric('ttk_nr')
+
+    def to_npz(self, file):
+        np.savez(file, metrics=np.array(self.metrics), guns=np.array(self.guns), distances=self.distances, hp=self.hp,
+                 data=self.data)
+
+    @classmethod
+    def from_npz(cls, file):
+        with np.load(file) as f:
+            metrics = tuple(f['metrics'])
+            if metrics not in (METRICS, METRICS + SENSITIVITY_METRICS):
+                raise ValueError(f"Results file has unknown metrics {metrics}")
+            return cls(f['guns'].tolist(), f['distances'], f['hp'], data=f['data'], sensitivity=metrics != METRICS)
+
+    def to_arrow(self):
+        """
+        Long-format pyarrow Table with one row per (weapon, distance, hp); metric columns are zero-copy views
+
+        :return: pyarrow.Table
+        """
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("Arrow export requires pyarrow (`pip install pyarrow`)")
+        n_guns, n_distances, n_hp = self.data.shape[1:]
+        gun_idx = np.repeat(np.arange(n_guns, dtype=np.int32), n_distances * n_hp)
+        columns = {
+            'gun': pa.DictionaryArray.from_arrays(pa.array(gun_idx), pa.array(self.guns)),
+            'distance': pa.array(np.tile(np.repeat(self.distances, n_hp), n_guns)),
+            'hp': pa.array(np.tile(self.hp, n_guns * n_distances)),
+        }
+        for name in self.metrics:
+            columns[name] = pa.array(self.metric(name).reshape(-1))
+        return pa.table(columns)
+
+    def to_store(self):
+        """
+        JSON-serializable form for a Dash Store; the array is shipped as raw base64 bytes
+
+        :return: dict
+        """
+        return dict(
+            guns=self.guns,
+            distances=self.distances.tolist(),
+            hp=self.hp.tolist(),
+            sensitivity=self.sensitivity,
+            dtype=self.data.dtype.str,
+            data=base64.b64encode(np.ascontiguousarray(self.data).data).decode('ascii'),
+        )
+
+    @classmethod
+    def from_store(cls, store):
+        """
+        :param store: dict from `to_store`
+        :return: AnalysisResults
+        """
+        sensitivity = store.get('sensitivity', False)
+        num_metrics = len(METRICS + SENSITIVITY_METRICS) if sensitivity else len(METRICS)
+        shape = (num_metrics, len(store['guns']), len(store['distances']), len(store['hp']))
+        data = np.frombuffer(base64.b64decode(store['data']), dtype=np.dtype(store['dtype'])).reshape(shape)
+        return cls(store['guns'], store['distances'], store['hp'], data=data, sensitivity=sensitivity)
@@ -0,0 +1,175 @@
+"""
+Debounced, latest-wins scheduling of analysis requests.
+
+Each client session gets a generation counter. Submitting work bumps the counter,
+waits out the debounce interval and only runs if nothing newer was submitted in
+the meantime. Running work is handed an `is_cancelled` callable so it can stop
+cooperatively as soon as a newer request for the same session arrives.
+
+Work can also be started as a background `Job` that publishes intermediate
+results as they come in, for clients that poll for progress.
+
+Generations and jobs are tracked per process, so superseded requests are only
+abandoned, and jobs can only be polled, on the same worker process (e.g.
+threaded gunicorn workers). Callers must handle `get_job` returning None, e.g. a
+poll that lands on another worker. Jobs are dropped once their final value was
+collected (`discard_job`), and finished jobs nobody collects expire after
+JOB_TTL seconds.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+DEFAULT_DEBOUNCE = 0.25     # seconds
+MAX_SESSIONS = 10000
+MAX_JOBS = 64               # jobs hold full results snapshots, so only a few are kept per process
+JOB_TTL = 120.              # seconds a finished job is kept for its final poll
+
+
+class AnalysisCancelled(Exception):
+    """Raised when a newer request supersedes the one being computed"""
+
+
+class Job:
+    """
+    Background run of a generator; the latest value it yielded can be polled
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.latest = None
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        self.finished_at = None
+        self._cond = threading.Condition()
+
+    def publish(self, value):
+        with self._cond:
+            self.latest = value
+            self.version += 1
+            self._cond.notify_all()
+
+    def finish(self, cancelled=False, error=None):
+        with self._cond:
+            self.done = True
+            self.cancelled = cancelled
+            self.error = error
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+
+    def wait(self, version=0, timeout=None):
+        """
+        Wait until a value newer than `version` is published or the job is done
+
+        :param version: last version seen by the caller
+        :param timeout: maximum wait in seconds
+        :return: (version, latest value, done)
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.version > version or self.done, timeout)
+            return self.version, self.latest, self.done
+
+
+class LatestWinsScheduler:
+
+    def __init__(self, debounce=DEFAULT_DEBOUNCE, max_sessions=MAX_SESSIONS, max_jobs=MAX_JOBS, job_ttl=JOB_TTL):
+        self.debounce = debounce
+        self.max_sessions = max_sessions
+        self.max_jobs = max_jobs
+        self.job_ttl = job_ttl
+        self._generations = OrderedDict()
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _next_generation(self, key):
+        with self._lock:
+            generation = self._generations.get(key, 0) + 1
+            self._generations[key] = generation
+            self._generations.move_to_end(key)
+            while len(self._generations) > self.max_sessions:
+                self._generations.popitem(last=False)
+            return generation
+
+    def run(self, key, fn):
+        """
+        Run fn(is_cancelled) after the debounce interval unless a newer call for the same key supersedes it
+
+        :param key: session key
+        :param fn: callable taking an `is_cancelled` callable
+        :return: return value of fn
+        :raises AnalysisCancelled: if superseded before or while running
+        """
+        generation = self._next_generation(key)
+
+        def is_cancelled():
+            with self._lock:
+                return self._generations.get(key) != generation
+
+        if self.debounce > 0:
+            time.sleep(self.debounce)
+        if is_cancelled():
+            raise AnalysisCancelled()
+        return fn(is_cancelled)
+
+    def start(self, key, fn):
+        """
+        Run `run(key, fn)` in a background thread, publishing every value fn yields
+
+        :param key: session key
+        :param fn: generator function taking an `is_cancelled` callable
+        :return: Job, also available from `get_job(key)` until a newer job for the key starts, the job is
+            discarded, or it expires JOB_TTL seconds after finishing; the oldest jobs are evicted beyond MAX_JOBS
+        """
+        job = Job()
+        with self._lock:
+            self._prune_jobs()
+            self._jobs[key] = job
+            self._jobs.move_to_end(key)
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+
+        def consume(is_cancelled):
+            for value in fn(is_cancelled):
+                job.publish(value)
+
+        def target():
+            try:
+                self.run(key, consume)
+            except AnalysisCancelled:
+                job.finish(cancelled=True)
+            except Exception as e:
+                job.finish(error=e)
+            else:
+                job.finish()
+
+        threading.Thread(target=target, daemon=True).start()
+        return job
+
+    def _prune_jobs(self):
+        now = time.monotonic()
+        expired = [key for key, job in self._jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > self.job_ttl]
+        for key in expired:
+            del self._jobs[key]
+
+    def get_job(self, key):
+        """
+        :param key: session key
+        :return: latest Job started for the key, or None
+        """
+        with self._lock:
+            self._prune_jobs()
+            return self._jobs.get(key)
+
+    def discard_job(self, key, job):
+        """
+        Forget a job whose final value was collected, unless a newer job for the key replaced it
+
+        :param key: session key
+        :param job: Job from `start` or `get_job`
+        """
+        with self._lock:
+            if self._jobs.get(key) is job:
+                del self._jobs[key]
@@ -0,0 +1,87 @@
+"""
+Validation of API queries and the JSON they stream back
+"""
+import json
+
+import pytest
+
+pytest.importorskip('flask')
+from flask import Flask
+
+import api
+
+
+with open('example.json', 'r') as f:
+    WEAPON = dict(json.load(f)[0], spread=[1.0, 1.0])
+
+
+def make_query(**kwargs):
+    query = dict(weapons=[WEAPON], distances=[10, 50], hp=[100, 250])
+    query.update(kwargs)
+    return query
+
+
+def reject_constant(name):
+    raise ValueError(f"Invalid JSON constant {name}")
+
+
+@pytest.fixture(scope='module')
+def client():
+    app = Flask(__name__)
+    app.register_blueprint(api.create_api())
+    return app.test_client()
+
+
+def read_lines(response):
+    return [json.loads(line, parse_constant=reject_constant) for line in response.get_data(as_text=True).splitlines()]
+
+
+@pytest.mark.parametrize('query', [
+    None,
+    make_query(weapons=[]),
+    make_query(weapons=[WEAPON] * (api.MAX_API_WEAPONS + 1)),
+    make_query(distances={'min': 10, 'max': 100, 'num': api.MAX_API_DISTANCES + 1}),
+    make_query(distances={'min': 10, 'max': 100, 'num': 1e300}),
+    make_query(distances={'min': 10, 'max': 100, 'num': 2.5}),
+    make_query(distances={'min': 10, 'max': 100, 'num': float('inf')}),
+    make_query(distances=[10.] * (api.MAX_API_DISTANCES + 1)),
+    make_query(distances=[]),
+    make_query(distances=[10, float('nan')]),
+    make_query(distances=[0, 10]),
+    make_query(spreads=[[0, 1]]),
+    make_query(spreads=[[float('nan'), 1]]),
+    make_query(spreads=[[1, 1], [1, 1]]),
+    make_query(hp=[]),
+    make_query(hp=float('nan')),
+    make_query(hp=[[100]]),
+    make_query(aim_center=[0, float('inf')]),
+    make_query(aim_center='neck'),
+    make_query(target='cod2'),
+    make_query(aim_error=-0.1),
+])
+def test_parse_query_rejects(query):
+    with pytest.raises(ValueError):
+        api.parse_query(query)
+
+
+def test_parse_query_rejects_distances_before_first_dropoff():
+    weapon = dict(WEAPON, damage_profile=[dict(WEAPON['damage_profile'][0], dropoff=20.)])
+    with pytest.raises(ValueError, match="dropoff"):
+        api.parse_query(make_query(weapons=[weapon], distances=[10, 30]))
+
+
+def test_analyze_rejects_aim_center_off_hitbox(client):
+    response = client.post('/api/analyze', json=make_query(aim_center=[5.0, 5.0]))
+    assert response.status_code == 400
+    assert 'hitbox' in response.get_json()['error']
+
+
+def test_analyze_streams_valid_json(client):
+    blank = dict(WEAPON, gun='Blank', damage_profile=[
+        dict(segment, head=0, chest=0, stomach=0, extremities=0) for segment in WEAPON['damage_profile']])
+    response = client.post('/api/analyze', json=make_query(weapons=[WEAPON, blank], sensitivity=True))
+    assert response.status_code == 200
+    lines = read_lines(response)
+    assert [line['type'] for line in lines] == ['meta', 'weapon', 'weapon', 'done']
+    assert all(value is not None for row in lines[1]['ttk'] for value in row)
+    assert all(value is None for row in lines[2]['ttk'] for value in row)
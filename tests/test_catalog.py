@@ -0,0 +1,45 @@
+"""
+Loadouts with several builds of one gun, from the catalog to the plotted curves
+"""
+import json
+
+import numpy as np
+import pytest
+
+import catalog
+import utils
+
+
+@pytest.fixture
+def weapon_catalog(tmp_path):
+    with open('example.json', 'r') as f:
+        base = json.load(f)[0]
+    fast = dict(base, fire_rate=base['fire_rate'] * 1.5)
+    weapon_catalog = catalog.WeaponCatalog(str(tmp_path / 'catalog.db'))
+    weapon_catalog.import_weapons([base, dict(fast, gun=base['gun'] + ' (2)')])
+    yield weapon_catalog
+    weapon_catalog.close()
+
+
+def test_loadout_suffixes_repeated_guns(weapon_catalog):
+    rows = weapon_catalog.search()
+    assert len(rows) == 2 and rows[0]['gun'] == rows[1]['gun']
+    loadout = weapon_catalog.get_loadout([catalog.get_weapon_id(wpn) for wpn in rows])
+    gun = rows[0]['gun']
+    assert [wpn['gun'] for wpn in loadout] == [gun, f"{gun} (2)"]
+    assert [wpn['fire_rate'] for wpn in loadout] == [wpn['fire_rate'] for wpn in rows]
+
+
+def test_plot_results_by_position():
+    with open('example.json', 'r') as f:
+        base = json.load(f)[0]
+    weapons = [dict(base, spread=(1., 1.)), dict(base, spread=(1., 1.), fire_rate=base['fire_rate'] * 1.5)]
+    distances = np.linspace(10, 50, 5)
+    results = utils.analyze(weapons, distances, utils.AIM_CENTER_DICT['chest'])
+    # Same name on purpose, as in loadouts built before names were made unique
+    results.guns = [base['gun'], base['gun']]
+    fig = utils.plot_results(distances, weapons, results, mode='ttk')
+    curves = [trace for trace in fig.data if not trace.name.endswith('(no recoil)')]
+    assert len(curves) == 2
+    np.testing.assert_allclose(curves[0].y, results.ttk[0, :, 0])
+    np.testing.assert_allclose(curves[1].y, results.ttk[1, :, 0])
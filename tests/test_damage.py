@@ -0,0 +1,38 @@
+"""
+STK and TTK of `utils.apply_damage` and `utils.analyze` when the aimed first shot alone kills
+"""
+import numpy as np
+
+import utils
+
+
+HP_LEVELS = np.array([100., 150., 200., 250.])
+SNIPER = dict(
+    gun='Sniper', fire_rate=50, ads=500, bullet_velocity=900., reload_time=3.5, mag_size=5, spread=(1.0, 1.0),
+    damage_profile=[dict(head=250, chest=130, stomach=110, extremities=100, dropoff=0.)],
+)
+
+
+def test_apply_damage_one_shot_kill():
+    distance = 100.
+    dps, stk, ttk = utils.apply_damage(120., distance, SNIPER, ads=True, hp=HP_LEVELS, free_hit=250)
+    np.testing.assert_array_equal(stk, 1)
+    np.testing.assert_allclose(ttk, distance / SNIPER['bullet_velocity'] + SNIPER['ads'] / 1000.)
+
+
+def test_apply_damage_free_hit_below_hp():
+    _, stk, ttk = utils.apply_damage(100., 50., SNIPER, hp=HP_LEVELS, free_hit=130)
+    np.testing.assert_array_equal(stk, [1, 2, 2, 3])
+    assert (np.diff(ttk) >= 0).all()
+    assert (ttk[1:] > ttk[0]).all()
+
+
+def test_analyze_one_shot_kill_across_hp():
+    distances = np.array([10., 50., 100.])
+    results = utils.analyze([SNIPER], distances, utils.AIM_CENTER_DICT['head'], ads=True, hp=HP_LEVELS,
+                            sensitivity=True)
+    np.testing.assert_array_equal(results.stk[0], 1)
+    expected = distances / SNIPER['bullet_velocity'] + SNIPER['ads'] / 1000.
+    np.testing.assert_allclose(results.ttk[0], np.broadcast_to(expected[:, None], results.ttk[0].shape))
+    np.testing.assert_array_equal(results.metric('dttk_dx')[0], 0)
+    np.testing.assert_array_equal(results.metric('dttk_dy')[0], 0)
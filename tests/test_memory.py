@@ -0,0 +1,53 @@
+"""
+Peak memory of single calls, measured with tracemalloc, for the widest beam the app allows
+"""
+import tracemalloc
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+import utils
+
+
+MAX_SPREAD = (2.51, 2.51)       # largest slider spread in degrees
+MAX_DISTANCE = 150.
+
+
+def get_peak_memory(fn, *args, **kwargs):
+    fn(*args, **kwargs)     # warm up lazily loaded artifacts
+    tracemalloc.start()
+    try:
+        fn(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.fixture(scope='module')
+def exact_model():
+    return utils.setup_beam_model(utils.AIM_CENTER_DICT['chest'], exact=True)
+
+
+@pytest.mark.parametrize('derivatives', [False, True])
+def test_beam_probabilities_single_distance(exact_model, derivatives):
+    peak = get_peak_memory(utils.get_beam_probabilities, exact_model, MAX_SPREAD, [MAX_DISTANCE],
+                           derivatives=derivatives)
+    assert peak < 1e6
+
+
+@pytest.mark.parametrize('derivatives', [False, True])
+def test_beam_probabilities_distance_grid(exact_model, derivatives):
+    distances = np.linspace(10, MAX_DISTANCE, 141)
+    peak = get_peak_memory(utils.get_beam_probabilities, exact_model, MAX_SPREAD, distances, derivatives=derivatives)
+    assert peak < 10e6
+
+
+@pytest.mark.parametrize('zoom', [1, 4])
+def test_beam_flipbook_render(zoom):
+    def render():
+        fig = utils.plot_beam_flipbook(dict(spread=MAX_SPREAD), np.arange(50, 151, 10), utils.AIM_CENTER_DICT['chest'],
+                                       zoom=zoom, fov=80)
+        fig.savefig(BytesIO(), format='png', facecolor=fig.get_facecolor())
+
+    assert get_peak_memory(render) < 40e6
@@ -0,0 +1,130 @@
+"""
+Permalink tokens come from URLs, so every malformed token must be rejected before it reaches the analysis
+"""
+import base64
+import json
+import zlib
+
+import pytest
+
+import permalink
+
+
+with open('example.json', 'r') as f:
+    WEAPONS = [dict(wpn, spread=(0.5 + 0.1 * i, 0.7)) for i, wpn in enumerate(json.load(f))]
+
+STATE = dict(weapons=WEAPONS, aim_center='chest', ads='no', distance=100, target='cod1', hp=[100.0, 250.0],
+             mode='ttk', x_mode='linear', y_mode='log', show_nr='hide', aim_error=2)
+
+
+def pack_token(packed):
+    raw = json.dumps(packed).encode()
+    return base64.urlsafe_b64encode(zlib.compress(raw)).decode('ascii').rstrip('=')
+
+
+def get_packed():
+    token = permalink.encode_state(STATE)
+    return json.loads(zlib.decompress(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))))
+
+
+def replace_weapon(stats=None, damage=None, spread=None):
+    packed = get_packed()
+    weapon = packed[1][0]
+    for i, value in enumerate((stats, damage, spread)):
+        if value is not None:
+            weapon[i] = value(weapon[i])
+    return pack_token(packed)
+
+
+def set_item(items, i, value):
+    items = list(items)
+    items[i] = value
+    return items
+
+
+def test_round_trip():
+    state = permalink.decode_state(permalink.encode_state(STATE))
+    assert {k: state[k] for k in permalink.SETTINGS} == {k: STATE[k] for k in permalink.SETTINGS}
+    assert len(state['weapons']) == len(WEAPONS)
+    for wpn, expected in zip(state['weapons'], WEAPONS):
+        assert wpn['spread'] == expected['spread']
+        assert wpn['damage_profile'] == expected['damage_profile']
+        assert all(wpn[k] == expected[k] for k in permalink.WEAPON_STATS if k in expected)
+
+
+def test_link_id_is_short_and_stable():
+    token = permalink.encode_state(STATE)
+    link_id = permalink.get_link_id(token)
+    assert len(link_id) == 12 and link_id == permalink.get_link_id(token)
+    assert link_id != permalink.get_link_id(permalink.encode_state(dict(STATE, distance=50)))
+
+
+def test_link_store(tmp_path):
+    links = permalink.LinkStore(str(tmp_path / 'links.db'))
+    token = permalink.encode_state(STATE)
+    link_id = links.put(token)
+    assert links.put(token) == link_id
+    assert links.get(link_id) == token
+    assert links.get('unknown') is None
+    links.close()
+
+
+STAT_INDEX = {k: i for i, k in enumerate(permalink.WEAPON_STATS)}
+
+
+@pytest.mark.parametrize('token', [
+    '',
+    'A' * (permalink.MAX_TOKEN_LENGTH + 1),
+    'not a token',
+    pack_token({'weapons': []}),
+    pack_token([permalink.PERMALINK_VERSION - 1] + get_packed()[1:]),
+    pack_token(get_packed()[:-1]),
+    pack_token(set_item(get_packed(), 1, 5)),
+    pack_token(set_item(get_packed(), 1, [[1, 2]])),
+    replace_weapon(stats=lambda s: s[:-1]),
+    replace_weapon(stats=lambda s: set_item(s, 0, 5)),
+    replace_weapon(stats=lambda s: set_item(s, STAT_INDEX['fire_rate'], "700")),
+    replace_weapon(stats=lambda s: set_item(s, STAT_INDEX['fire_rate'], True)),
+    replace_weapon(stats=lambda s: set_item(s, STAT_INDEX['fire_rate'], None)),
+    replace_weapon(stats=lambda s: set_item(s, STAT_INDEX['bullet_velocity'], float('inf'))),
+    replace_weapon(stats=lambda s: set_item(s, STAT_INDEX['reload_time'], float('nan'))),
+    replace_weapon(stats=lambda s: set_item(s, STAT_INDEX['mag_size'], 0)),
+    replace_weapon(damage=lambda d: []),
+    replace_weapon(damage=lambda d: "damage"),
+    replace_weapon(damage=lambda d: [d[0][:-1]]),
+    replace_weapon(damage=lambda d: [set_item(d[0], 0, -10)]),
+    replace_weapon(spread=lambda s: [0, 1]),
+    replace_weapon(spread=lambda s: [1, 1, 1]),
+    replace_weapon(spread=lambda s: ["1", 1]),
+])
+def test_decode_rejects_malformed_tokens(token):
+    with pytest.raises(ValueError):
+        permalink.decode_state(token)
+
+
+@pytest.mark.parametrize('changes', [
+    dict(weapons=[]),
+    dict(weapons=WEAPONS * 7),
+    dict(aim_center='neck'),
+    dict(target='cod2'),
+    dict(mode='kd'),
+    dict(ads='maybe'),
+    dict(distance=10.5),
+    dict(distance=1000),
+    dict(hp=[123.0]),
+    dict(hp=100.0),
+    dict(aim_error='2'),
+    dict(aim_error=1e9),
+])
+def test_app_rejects_unsupported_settings(changes):
+    pytest.importorskip('dash')
+    import app
+    state = permalink.decode_state(permalink.encode_state(dict(STATE, **changes)))
+    with pytest.raises(ValueError):
+        app.check_permalink_state(state)
+
+
+def test_app_accepts_round_trip():
+    pytest.importorskip('dash')
+    import app
+    app.check_permalink_state(permalink.decode_state(permalink.encode_state(STATE)))
@@ -0,0 +1,46 @@
+"""
+Beam images rendered concurrently from several threads must match serial renders byte for byte
+"""
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+
+import utils
+
+
+NUM_THREADS = 8
+SPREADS = [(0.3, 0.4), (1.0, 1.0), (2.51, 1.5), (0.05, 2.0)]
+
+
+def render_png(fig):
+    out = BytesIO()
+    fig.savefig(out, format='png', facecolor=fig.get_facecolor())
+    return out.getvalue()
+
+
+def render_profile(spread):
+    return render_png(utils.plot_beam_profile(dict(spread=spread), 70, utils.AIM_CENTER_DICT['chest'], zoom=4))
+
+
+def render_flipbook(spread):
+    return render_png(utils.plot_beam_flipbook(dict(spread=spread), np.arange(50, 151, 50),
+                                               utils.AIM_CENTER_DICT['head'], zoom=2, aim_error=0.05))
+
+
+def check_concurrent_renders(render):
+    jobs = SPREADS * 4
+    serial = {spread: render(spread) for spread in SPREADS}
+    with ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
+        concurrent = list(executor.map(render, jobs))
+    assert len(set(serial.values())) == len(SPREADS)
+    for spread, png in zip(jobs, concurrent):
+        assert png == serial[spread]
+
+
+def test_concurrent_beam_profiles():
+    check_concurrent_renders(render_profile)
+
+
+def test_concurrent_beam_flipbooks():
+    check_concurrent_renders(render_flipbook)
@@ -27,7 +27,7 @@ def get_damage_profile(gun, mode, damage_type='Default'):
     return profile
 
 
-def get_weapons_data(link):
+def get_weapons_data(link, damage_type='Default'):
     summary = get_summary(link)
     weapons = summary[0]
     mode = summary[-1]
@@ -44,7 +44,7 @@ def get_weapons_data(link):
         stats = wpn['summaryStats']
         fire_rate, range_modifier, ads, sprint_to_fire, tactical_sprint_to_fire = stats[:5]
         bullet_velocity, reload_time, mag_size = stats[10:13]
-        damage_profile = get_damage_profile(gun, mode)
+        damage_profile = get_damage_profile(gun, mode, damage_type=damage_type)
         for d in damage_profile:
             d['dropoff'] = d['dropoff'] * (1 + range_modifier)
         out.append(dict(
@@ -58,6 +58,8 @@ def get_weapons_data(link):
             reload_time=reload_time,
             mag_size=mag_size,
             damage_profile=damage_profile,
+            mode=mode,
+            damage_type=damage_type,
         ))
     return out
 
@@ -1,35 +1,69 @@
+import colorsys
+import math
+
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 import plotly.graph_objects as go
 from plotly.colors import DEFAULT_PLOTLY_COLORS
 
-plt.switch_backend('Agg')
-plt.rcParams['font.size'] = 18
-plt.style.use('dark_background')
+from cache import make_key
+from hitboxes import DEFAULT_HITBOX, HITBOXES, get_hitbox
+from results import METRICS, AnalysisResults
+from scheduler import AnalysisCancelled
+
+try:
+    from scipy.special import erf
+except ImportError:
+    _erf = np.frompyfunc(math.erf, 1, 1)
 
+    def erf(x):
+        """Elementwise error function; scipy, if installed, provides a faster one"""
+        return _erf(x).astype(float)
 
-# Hitbox was generated externally with photoshop and some down-sampling
-DEFAULT_TARGET_FILEPATH = 'hitbox_cod1.npy'
-# The "regions" are painted in with the following grayscale colors:
-TARGET_REGIONS = {'head': 255, 'chest': 207, 'stomach': 126, 'extremities': 71, 'miss': 0}
 
-# Load hit-box array and transpose it so that rows -> X values and columns -> Y values
-TARGET = np.load(DEFAULT_TARGET_FILEPATH)[::-1].T
+# Default hitbox model, see hitboxes.HITBOXES for the scale and region-color metadata
+TARGET_MODEL = get_hitbox()
+DEFAULT_TARGET_FILEPATH = TARGET_MODEL.filepath
+TARGET_REGIONS = TARGET_MODEL.regions
+TARGET = TARGET_MODEL.target
 
 # Conversion factor for going between pixels and meters in target frame.
-MODEL_HEIGHT_PIXELS = 404   # pixel height of HITBOX
-MODEL_HEIGHT_METERS = 1.8   # estimated physical height, about 6 ft
-IM_SCALE = MODEL_HEIGHT_PIXELS / MODEL_HEIGHT_METERS
+MODEL_HEIGHT_PIXELS = TARGET_MODEL.height_pixels
+MODEL_HEIGHT_METERS = TARGET_MODEL.height_meters
+IM_SCALE = TARGET_MODEL.im_scale
 
 # Target hp for TTK/STK calculation
 DEFAULT_TARGET_HP = 250.0
 
+# Beam box width in units of the Gaussian beam sigma
+BEAM_GAUSSIAN_SCALE = 3.
+
+# Number of distances evaluated between cancellation checks
+DISTANCE_CHUNK_SIZE = 25
+
+# Spread increment in degrees (on both axes) for the sensitivity overlay of plot_results
+SENSITIVITY_SPREAD_STEP = 0.1
+
+# Switch plot_results to WebGL traces when plotting more weapons than this
+WEBGL_MIN_WEAPONS = len(DEFAULT_PLOTLY_COLORS)
+
+# Width / height of one bullet distribution frame
+SCREEN_ASPECT = 16 / 9.
 
-def get_aim_center(offset, target=TARGET, im_center=None):
-    offset_x = int(offset[0] * IM_SCALE)
-    offset_y = int(offset[1] * IM_SCALE)
+# Offset from image center in meters (horizontal, vertical)
+AIM_CENTER_DICT = {
+    'stomach': (0.07, 0.07),
+    # 'stomach/chest': (0.03, 0.28),
+    'chest': (0.0, 0.45),
+    'head': (-0.07, 0.72),
+}
+
+
+def get_aim_center(offset, target=TARGET, im_center=None, im_scale=IM_SCALE):
+    offset_x = int(offset[0] * im_scale)
+    offset_y = int(offset[1] * im_scale)
     if im_center is None:
         im_center = (int(target.shape[0] / 2), int(target.shape[1] / 2))
     aim_x = im_center[0] + offset_x
@@ -38,11 +72,27 @@ def get_aim_center(offset, target=TARGET, im_center=None):
     return center
 
 
-def get_beam_box(center_pix, spread, distance, im_scale=IM_SCALE):
+def get_beam_box(center_pix, spread, distance, im_scale=IM_SCALE, aim_error=None):
+    """
+    Beam box in pixels; its width is BEAM_GAUSSIAN_SCALE beam sigmas
+
+    :param center_pix: aim center in pixels
+    :param spread: (horizontal, vertical) spread in degrees
+    :param distance: distance in meters
+    :param im_scale: pixels per meter
+    :param aim_error: optional (horizontal, vertical) standard deviation of Gaussian aim jitter in meters.
+        Gaussians compose in closed form, so the jitter just widens the beam: the beam exp(-(x / sigma)^2)
+        has a standard deviation of sigma / sqrt(2), so sigma^2 becomes sigma^2 + 2 * aim_error^2
+    :return: (x0, x1, y0, y1)
+    """
     spread_pix = (
         spread[0] * (np.pi / 180.) * distance * im_scale,
         spread[1] * (np.pi / 180.) * distance * im_scale
     )
+    if aim_error is not None:
+        spread_pix = tuple(
+            np.sqrt(s ** 2 + 2 * (BEAM_GAUSSIAN_SCALE * a * im_scale) ** 2) for s, a in zip(spread_pix, aim_error)
+        )
     beam_box = (
         center_pix[0] - spread_pix[0] / 2,
         center_pix[0] + spread_pix[0] / 2,
@@ -52,132 +102,460 @@ def get_beam_box(center_pix, spread, distance, im_scale=IM_SCALE):
     return beam_box
 
 
-def create_targets(damage_profile, target=TARGET, target_regions=TARGET_REGIONS):
-    num_segments = len(damage_profile)
-    out = np.zeros((num_segments, *target.shape), dtype=float)
-    for i in range(out.shape[0]):
-        dmg = {v: damage_profile[i][k] for k, v in target_regions.items() if k != 'miss'}
-        for k, v in dmg.items():
-            out[i, target == k] = v
-    return out
+def resolve_target(target, target_regions=TARGET_REGIONS):
+    """
+    Look up a hitbox model by name, or pass through a hitbox array
 
+    :param target: name of a registered hitbox model or hitbox array
+    :param target_regions: region colors, only used for hitbox arrays
+    :return: hitbox array, region colors, pixels per meter, Hitbox (None for arrays)
+    """
+    if isinstance(target, str):
+        hitbox = get_hitbox(target)
+        return hitbox.target, hitbox.regions, hitbox.im_scale, hitbox
+    return target, target_regions, IM_SCALE, None
 
-def create_beam_profile(im_shape, beam_box, gaussian=True, gaussian_scale=3.):
-    x0, x1, y0, y1 = beam_box
-    x_spread = x1 - x0
-    y_spread = y1 - y0
-    center = (x0 + x_spread / 2, y0 + y_spread / 2)
-    Y, X = np.meshgrid(range(im_shape[1]), range(im_shape[0]))
-    if gaussian:
-        x_sigma = x_spread / gaussian_scale
-        y_sigma = y_spread / gaussian_scale
-        out = np.exp(-((X - center[0]) / x_sigma) ** 2 - ((Y - center[1]) / y_sigma) ** 2)
-    else:
-        out = np.zeros(im_shape, dtype=float)
-        out[(X > x0) & (X < x1) & (Y > y0) & (Y < y1)] = 1
-    out /= out.sum()
-    return out
 
+def get_region_masks(target=TARGET, target_regions=TARGET_REGIONS):
+    regions = [k for k in target_regions.keys() if k != 'miss']
+    masks = np.stack([target == target_regions[k] for k in regions]).astype(float)
+    return regions, masks
 
-def resize_target(target, center_pix, beam_box):
-    x0, x1, y0, y1 = beam_box
-    beam_x = x1 - x0
-    beam_y = y1 - y0
-    padding = (
-        (
-            max(0, int(np.ceil(-x0))),
-            max(0, int(np.ceil(x1 - target.shape[0]))),
-        ),
-        (
-            max(0, int(np.ceil(-y0))),
-            max(0, int(np.ceil(y1 - target.shape[1]))),
-        )
-    )
-    target_new = np.pad(target, padding)
-    center_pix_new = (center_pix[0] + padding[0][0], center_pix[1] + padding[1][0])
-    beam_box_new = (
-        center_pix_new[0] - beam_x / 2,
-        center_pix_new[0] + beam_x / 2,
-        center_pix_new[1] - beam_y / 2,
-        center_pix_new[1] + beam_y / 2,
-    )
-    return target_new, center_pix_new, beam_box_new
+
+def get_region_rectangles(target=TARGET, target_regions=TARGET_REGIONS):
+    """
+    Decompose every region except 'miss' into axis-aligned rectangles of pixels
+
+    Runs of region pixels along y are found in every x-row, and identical runs in
+    consecutive rows are merged into one rectangle, so a blocky hitbox becomes a
+    few hundred rectangles instead of tens of thousands of pixels.
+
+    :param target: hitbox array
+    :param target_regions: hitbox region colors
+    :return: list of region names, int array (rectangles, 5) of (region index, x0, x1, y0, y1)
+        with half-open pixel bounds
+    """
+    regions, masks = get_region_masks(target=target, target_regions=target_regions)
+    rectangles = []
+    for k, mask in enumerate(masks > 0):
+        padded = np.pad(mask, ((0, 1), (1, 1))).astype(np.int8)
+        open_runs = {}      # (y0, y1) -> x0
+        for x, row in enumerate(padded):
+            edges = np.flatnonzero(np.diff(row))
+            runs = set(zip(edges[::2].tolist(), edges[1::2].tolist()))
+            for run in set(open_runs) - runs:
+                rectangles.append((k, open_runs.pop(run), x) + run)
+            for run in runs - set(open_runs):
+                open_runs[run] = x
+    return regions, np.array(rectangles, dtype=int).reshape(-1, 5)
+
+
+def get_rectangle_probabilities(center_pix, sigma, rectangles, num_regions, derivatives=False):
+    """
+    Exact hit probability of each region for a Gaussian beam exp(-((x - c) / sigma)^2) over pixel rectangles
+
+    Pixel i covers [i - 0.5, i + 0.5], so the beam mass in a rectangle is a product of two 1-D erf
+    differences and a region's probability is a sum of such products. The cost scales with the number of
+    distinct rectangle edges rather than with the number of pixels, and any number of beams (e.g. one per
+    distance) is evaluated in one broadcast. Beam mass falling outside of the image counts as a miss.
+
+    With `derivatives`, the exact derivatives with respect to the horizontal and vertical sigma are
+    computed in the same pass, using d/dsigma erf(u) / 2 = -u exp(-u^2) / (sqrt(pi) sigma), u = (e - c) / sigma.
+
+    :param center_pix: aim center in pixels
+    :param sigma: (horizontal, vertical) beam sigma in pixels, scalars or arrays of equal shape
+    :param rectangles: int array (rectangles, 5) from `get_region_rectangles`
+    :param num_regions: number of regions
+    :param derivatives: also return the derivatives with respect to sigma
+    :return: array (..., regions) of hit probabilities, and if `derivatives` an array (..., 2, regions)
+        of derivatives with respect to the x and y sigma in pixels
+    """
+    sigma_x, sigma_y = np.broadcast_arrays(np.asarray(sigma[0], dtype=float), np.asarray(sigma[1], dtype=float))
+    owner = np.zeros((len(rectangles), num_regions))
+    owner[np.arange(len(rectangles)), rectangles[:, 0]] = 1
+    masses = []
+    dmasses = []
+    for c, s, bounds in ((center_pix[0], sigma_x, rectangles[:, 1:3]), (center_pix[1], sigma_y, rectangles[:, 3:5])):
+        # Evaluate the CDF once per distinct edge, then gather it for every rectangle
+        edges, idx = np.unique(bounds, return_inverse=True)
+        idx = idx.reshape(bounds.shape)
+        with np.errstate(divide='ignore'):
+            u = (edges - 0.5 - c) / s[..., None]     # zero sigma is a point beam, erf(+-inf) = +-1
+        cdf = erf(u) / 2
+        masses.append(cdf[..., idx[:, 1]] - cdf[..., idx[:, 0]])
+        if derivatives:
+            dcdf = -u * np.exp(-u ** 2) / (np.sqrt(np.pi) * s[..., None])
+            dmasses.append(dcdf[..., idx[:, 1]] - dcdf[..., idx[:, 0]])
+    mass_x, mass_y = masses
+    probs = (mass_x * mass_y) @ owner
+    if not derivatives:
+        return probs
+    dmass_x, dmass_y = dmasses
+    dprobs = np.stack([(dmass_x * mass_y) @ owner, (mass_x * dmass_y) @ owner], axis=-2)
+    return probs, dprobs
+
+
+def get_center_region(center_pix, target=TARGET, target_regions=TARGET_REGIONS):
+    """
+    Name of the hitbox region under the aim center, or None if it misses
+
+    :param center_pix: aim center in pixels
+    :param target: hitbox array
+    :param target_regions: hitbox region colors
+    :return: region name
+    """
+    if not (0 <= center_pix[0] < target.shape[0] and 0 <= center_pix[1] < target.shape[1]):
+        return None
+    value = target[center_pix[0], center_pix[1]]
+    for k, v in target_regions.items():
+        if k != 'miss' and v == value:
+            return k
+    return None
 
 
 def apply_damage(dpr, distance, wpn, ads=False, hp=DEFAULT_TARGET_HP, free_hit=0):
+    """
+    Convert damage per round into DPS, STK and TTK
+
+    All arguments broadcast, so weapon stats may also be arrays, e.g. one row per build.
+
+    :param dpr: expected damage per round
+    :param distance: distance in meters
+    :param wpn: weapon data dict
+    :param ads: add ADS time to TTK
+    :param hp: target hp, scalar or array; outputs broadcast over it
+    :param free_hit: damage of a guaranteed first hit (0 for none), scalar or array
+    :return: dps, stk, ttk
+    """
     rps = wpn['fire_rate'] / 60.
-    if free_hit > 0:
-        hp -= free_hit
-        stk = int(np.ceil(hp / dpr)) + 1
-    else:
-        stk = int(np.ceil(hp / dpr))
+    hp = np.asarray(hp, dtype=float)
+    has_free_hit = np.asarray(free_hit) > 0
+    # HP left after the free hit; 0 if the free hit alone kills
+    hp = np.maximum(hp - np.where(has_free_hit, free_hit, 0), 0)
+    one_shot = has_free_hit & (hp == 0)
     dps = dpr * rps
+    with np.errstate(invalid='ignore'):
+        stk = np.where(one_shot, 0, np.ceil(hp / dpr)) + has_free_hit
+        t_fire = np.where(one_shot, 0, hp / dps + has_free_hit / rps)
     t_travel = distance / wpn['bullet_velocity']
-    t_reload = wpn['reload_time'] * int((stk - 1) / wpn['mag_size'])
-    ttk = hp / dps + t_travel + t_reload
-    if free_hit > 0:
-        ttk += 1. / rps
+    t_reload = wpn['reload_time'] * np.floor((stk - 1) / wpn['mag_size'])
+    ttk = t_fire + t_travel + t_reload
     if ads:
         ttk += wpn['ads'] / 1000.
     return dps, stk, ttk
 
 
-def analyze(weapons, distances, center, ads=False, target=TARGET, target_regions=TARGET_REGIONS):
-    center_pix = get_aim_center(center, target=target)
-    num_distances = len(distances)
-    dps = {wpn['gun']: np.zeros(num_distances) for wpn in weapons}
-    stk = {wpn['gun']: np.zeros(num_distances) for wpn in weapons}
-    ttk = {wpn['gun']: np.zeros(num_distances) for wpn in weapons}
-    dps_nr = {wpn['gun']: np.zeros(num_distances) for wpn in weapons}
-    stk_nr = {wpn['gun']: np.zeros(num_distances) for wpn in weapons}
-    ttk_nr = {wpn['gun']: np.zeros(num_distances) for wpn in weapons}
-    for wpn in weapons:
-        gun = wpn['gun']
-        damage_profile = wpn['damage_profile']
-        targets_dmg = create_targets(
-            damage_profile,
-            target=target,
-            target_regions=target_regions
-        )
-        edges = [d['dropoff'] for d in damage_profile]
-        edges.append(1e99)
-        for i in range(len(edges) - 1):
-            target_dmg = targets_dmg[i]
-            dpr_nr = target_dmg[center_pix[0], center_pix[1]]
-            if dpr_nr > 0:
-                a, b = edges[i: i + 2]
-                segment = (distances >= a) & (distances < b)
-                distances_segment = distances[segment]
-                dps_segment = np.zeros(len(distances_segment))
-                stk_segment = np.zeros(len(distances_segment))
-                ttk_segment = np.zeros(len(distances_segment))
-                dps_nr_segment = np.zeros(len(distances_segment))
-                stk_nr_segment = np.zeros(len(distances_segment))
-                ttk_nr_segment = np.zeros(len(distances_segment))
-                for j, distance in enumerate(distances_segment):
-                    distance = distances_segment[j]
-                    spread = wpn['spread']
-                    beam_box = get_beam_box(center_pix, spread, distance)
-                    target_dmg_new, _, beam_box_new = resize_target(target_dmg, center_pix, beam_box)
-                    beam_profile = create_beam_profile(target_dmg_new.shape, beam_box_new)
-                    dpr = np.sum(target_dmg_new * beam_profile)
-                    results = apply_damage(dpr, distance, wpn, ads=ads, free_hit=dpr_nr)
-                    results_nr = apply_damage(dpr_nr, distance, wpn, ads=ads)
-                    dps_segment[j], stk_segment[j], ttk_segment[j] = results
-                    dps_nr_segment[j], stk_nr_segment[j], ttk_nr_segment[j] = results_nr
-                dps[gun][segment] = dps_segment
-                stk[gun][segment] = stk_segment
-                ttk[gun][segment] = ttk_segment
-                dps_nr[gun][segment] = dps_nr_segment
-                stk_nr[gun][segment] = stk_nr_segment
-                ttk_nr[gun][segment] = ttk_nr_segment
+def get_aim_error(aim_error):
+    """
+    Normalize an aim error argument
+
+    :param aim_error: None, a standard deviation in meters, or (horizontal, vertical) standard deviations
+    :return: (horizontal, vertical) tuple of floats, or None for no aim error
+    """
+    if aim_error is None:
+        return None
+    aim_error = tuple(float(a) for a in np.broadcast_to(aim_error, 2))
+    if any(a < 0 for a in aim_error):
+        raise ValueError("Aim error must not be negative")
+    return aim_error if any(aim_error) else None
+
+
+def setup_beam_model(center, target=TARGET, target_regions=TARGET_REGIONS, lookup_table=None, exact=False,
+                     aim_error=None):
+    """
+    Gather everything the beam evaluation needs for one hitbox and aim center
+
+    :param center: aim center offset in meters
+    :param aim_error: optional (horizontal, vertical) aim jitter in meters, see `get_beam_box`
+    :param target: name of a registered hitbox model or hitbox array
+    :param target_regions: hitbox region colors, only used for hitbox arrays
+    :param lookup_table: optional lookup table, defaults to the cached table of a named hitbox model
+    :param exact: always evaluate the beam on the hitbox pixels, ignoring any lookup table
+    :return: dict describing the beam model, see `get_beam_probabilities`. The lookup table is dropped
+        if it does not tabulate the aim center.
+    """
+    from lookup import get_center_index
+    target, target_regions, im_scale, hitbox = resolve_target(target, target_regions)
+    if exact:
+        lookup_table = None
+    elif lookup_table is None and hitbox is not None:
+        lookup_table = hitbox.get_lookup_table()
+    if lookup_table is not None and get_center_index(lookup_table, center) is None:
+        lookup_table = None
+    center_pix = get_aim_center(center, target=target, im_scale=im_scale)
+    center_region = get_center_region(center_pix, target=target, target_regions=target_regions)
+    if center_region is None:
+        raise ValueError("Aim center must be inside of hitbox")
+    # Rectangles are kept with a lookup table too, for beams outside of its sigma range
+    if hitbox is not None:
+        regions, rectangles = hitbox.rectangles
+    else:
+        regions, rectangles = get_region_rectangles(target=target, target_regions=target_regions)
+    if lookup_table is not None and list(lookup_table['regions']) != list(regions):
+        raise ValueError("Lookup table regions do not match the hitbox")
+    return dict(
+        center=center,
+        center_pix=center_pix,
+        center_region=center_region,
+        regions=regions,
+        rectangles=rectangles,
+        im_scale=im_scale,
+        hitbox=hitbox,
+        lookup_table=lookup_table,
+        aim_error=get_aim_error(aim_error),
+    )
+
+
+def get_beam_probabilities(model, spread, distances, derivatives=False):
+    """
+    Region hit probabilities of the beam at each distance
+
+    :param model: beam model from `setup_beam_model`
+    :param spread: (horizontal, vertical) spread in degrees
+    :param distances: array of distances in meters
+    :param derivatives: also return the derivatives with respect to spread; needs an exact model
+    :return: array (distances, regions), and if `derivatives` an array (distances, 2, regions) of
+        derivatives with respect to the horizontal and vertical spread in degrees
+    """
+    if model['lookup_table'] is not None:
+        if derivatives:
+            raise ValueError("Spread derivatives need an exact beam model, see `setup_beam_model`")
+        from lookup import get_linear_sigma, covers_sigma, query_region_probabilities
+        sigma = get_linear_sigma(spread, distances, aim_error=model['aim_error'])
+        # Beams outside of the tabulated sigma range (e.g. zero spread) use the exact model below
+        if covers_sigma(model['lookup_table'], sigma):
+            return query_region_probabilities(model['lookup_table'], model['center'], sigma)
+    distances = np.asarray(distances, dtype=float)
+    beam_box = get_beam_box(model['center_pix'], spread, distances, im_scale=model['im_scale'],
+                            aim_error=model['aim_error'])
+    sigma = np.stack([beam_box[1] - beam_box[0], beam_box[3] - beam_box[2]], axis=-1) / BEAM_GAUSSIAN_SCALE
+    out = get_rectangle_probabilities(model['center_pix'], (sigma[:, 0], sigma[:, 1]), model['rectangles'],
+                                      len(model['regions']), derivatives=derivatives)
+    if not derivatives:
+        return out
+    probs, dprobs = out
+    # Chain rule: sigma in pixels is linear in spread in degrees, and with aim error
+    # d(sigma_eff) / d(sigma) = sigma / sigma_eff
+    dsigma = (np.pi / 180.) * model['im_scale'] / BEAM_GAUSSIAN_SCALE * np.stack([distances, distances], axis=-1)
+    if model['aim_error'] is not None:
+        dsigma = dsigma ** 2 * np.asarray(spread, dtype=float) / sigma
+    return probs, dprobs * dsigma[:, :, None]
+
+
+def iter_analyze_weapon(wpn, distances, model, out, ads=False, hp=DEFAULT_TARGET_HP, is_cancelled=None,
+                        chunk_size=DISTANCE_CHUNK_SIZE):
+    """
+    Compute DPS, STK and TTK with and without recoil for one weapon, one chunk of distances at a time
+
+    :param wpn: weapon data dict with a 'spread' entry
+    :param distances: array of distances in meters
+    :param model: beam model from `setup_beam_model`
+    :param out: array (metric, distance, hp) to fill in, in results.METRICS order, optionally
+        followed by results.SENSITIVITY_METRICS, which needs an exact beam model
+    :param ads: add ADS time to TTK
+    :param hp: 1-D array of target hp
+    :param is_cancelled: optional callable checked between chunks of distances
+    :param chunk_size: number of distances per chunk
+    :return: generator of the distance indices filled in by each chunk
+    :raises AnalysisCancelled: if `is_cancelled` returns True
+    """
+    damage_profile = wpn['damage_profile']
+    dps, stk, ttk, dps_nr, stk_nr, ttk_nr = out[:len(METRICS)]
+    sensitivity = len(out) > len(METRICS)
+    edges = [d['dropoff'] for d in damage_profile]
+    edges.append(1e99)
+    for i in range(len(edges) - 1):
+        region_dmg = np.array([damage_profile[i][k] for k in model['regions']], dtype=float)
+        dpr_nr = damage_profile[i][model['center_region']]
+        a, b = edges[i: i + 2]
+        segment_idx = np.flatnonzero((distances >= a) & (distances < b))
+        for start in range(0, len(segment_idx), chunk_size):
+            if is_cancelled is not None and is_cancelled():
+                raise AnalysisCancelled()
+            chunk = segment_idx[start: start + chunk_size]
+            distances_chunk = distances[chunk]
+            if sensitivity:
+                probs, dprobs = get_beam_probabilities(model, wpn['spread'], distances_chunk, derivatives=True)
             else:
-                raise ValueError("Aim center must be inside of hitbox")
-    results = (dps, stk, ttk, dps_nr, stk_nr, ttk_nr)
+                probs = get_beam_probabilities(model, wpn['spread'], distances_chunk)
+            dpr_chunk = (probs @ region_dmg)[:, None]
+            distances_chunk = distances_chunk[:, None]
+            dps[chunk], stk[chunk], ttk[chunk] = apply_damage(
+                dpr_chunk, distances_chunk, wpn, ads=ads, hp=hp, free_hit=dpr_nr)
+            if sensitivity:
+                # STK and reloads are piecewise constant in spread, so only the hp / dps term of TTK varies
+                ddps = (dprobs @ region_dmg) * wpn['fire_rate'] / 60.
+                for k in range(2):
+                    out[len(METRICS) + k, chunk] = ddps[:, k, None]
+                    out[len(METRICS) + 2 + k, chunk] = -np.maximum(hp - dpr_nr, 0) / dps[chunk] ** 2 * ddps[:, k, None]
+            dps_nr[chunk], stk_nr[chunk], ttk_nr[chunk] = apply_damage(
+                dpr_nr, distances_chunk, wpn, ads=ads, hp=hp)
+            yield chunk
+
+
+def get_weapon_key(wpn, distances, model, ads, hp, sensitivity=False):
+    """
+    Cache key for one weapon's results; the weapon's display name is not part of it
+
+    :return: hex digest, or None if the hitbox is not a registered model
+    """
+    if model['hitbox'] is None:
+        return None
+    stats = {k: v for k, v in wpn.items() if k != 'gun'}
+    return make_key(
+        stats, model['center'], bool(ads), model['hitbox'].key, model['lookup_table'] is not None,
+        np.asarray(distances, dtype=float), np.asarray(hp, dtype=float), bool(sensitivity), model['aim_error'],
+    )
+
+
+def iter_analyze(weapons, distances, center, ads=False, target=TARGET, target_regions=TARGET_REGIONS,
+                 lookup_table=None, hp=DEFAULT_TARGET_HP, cache=None, is_cancelled=None, sensitivity=False,
+                 aim_error=None):
+    """
+    Compute DPS, STK and TTK with and without recoil for each weapon, yielding progress as results come in.
+    Takes the same arguments as `analyze`.
+
+    Results are filled in one weapon and one chunk of distances at a time; entries that are
+    not computed yet are NaN. Each step yields the shared results object, the index of the
+    weapon being computed and the number of its distances done so far, so a weapon is
+    complete when that number equals the number of distances.
+
+    :return: generator of (AnalysisResults, weapon index, number of distances done)
+    :raises AnalysisCancelled: if `is_cancelled` returns True
+    """
+    model = setup_beam_model(center, target=target, target_regions=target_regions, lookup_table=lookup_table,
+                             exact=sensitivity, aim_error=aim_error)
+    results = AnalysisResults([wpn['gun'] for wpn in weapons], distances, hp, sensitivity=sensitivity)
+    results.data[:] = np.nan
+    num_distances = len(results.distances)
+    for w, wpn in enumerate(weapons):
+        key = None
+        if cache is not None:
+            key = get_weapon_key(wpn, results.distances, model, ads, results.hp, sensitivity=sensitivity)
+            cached = cache.get(key)
+            if cached is not None:
+                results.data[:, w] = cached
+                yield results, w, num_distances
+                continue
+        num_done = 0
+        for chunk in iter_analyze_weapon(wpn, results.distances, model, results.data[:, w], ads=ads, hp=results.hp,
+                                         is_cancelled=is_cancelled):
+            num_done += len(chunk)
+            if num_done < num_distances:
+                yield results, w, num_done
+        if key is not None:
+            cache.put(key, results.data[:, w].copy())
+        yield results, w, num_distances
+
+
+def analyze(weapons, distances, center, ads=False, target=TARGET, target_regions=TARGET_REGIONS, lookup_table=None,
+            hp=DEFAULT_TARGET_HP, cache=None, is_cancelled=None, sensitivity=False, aim_error=None):
+    """
+    Compute DPS, STK and TTK with and without recoil for each weapon
+
+    :param weapons: list of weapon data dicts, each with a 'spread' entry
+    :param distances: array of distances in meters
+    :param center: aim center offset in meters
+    :param ads: add ADS time to TTK
+    :param target: name of a registered hitbox model or hitbox array
+    :param target_regions: hitbox region colors, only used for hitbox arrays
+    :param lookup_table: optional table from `lookup.load_lookup_table`; if given, region
+        hit probabilities are interpolated from it instead of computed from the hitbox pixels.
+        Defaults to the cached table of a named hitbox model, if it has been built
+    :param hp: target hp, scalar or 1-D array; the beam is evaluated once for all values
+    :param cache: optional cache.LRUCache of per-weapon results, only used with named hitbox models.
+        Weapons whose stats, spread, aim center, ADS flag, distances and hp are cached are not recomputed
+    :param is_cancelled: optional callable checked between weapons and chunks of distances
+    :param sensitivity: also compute the derivatives of DPS and TTK with respect to horizontal and
+        vertical spread in degrees (results.SENSITIVITY_METRICS). These are exact derivatives of
+        the pixel-level beam model, so the lookup table is not used
+    :param aim_error: optional standard deviation of Gaussian aim jitter in meters, one value or
+        (horizontal, vertical). It is combined with the weapon spread in closed form, see `get_beam_box`
+    :return: AnalysisResults
+    :raises AnalysisCancelled: if `is_cancelled` returns True
+    """
+    results = AnalysisResults([wpn['gun'] for wpn in weapons], distances, hp, sensitivity=sensitivity)
+    for results, _, _ in iter_analyze(weapons, distances, center, ads=ads, target=target,
+                                      target_regions=target_regions, lookup_table=lookup_table, hp=hp, cache=cache,
+                                      is_cancelled=is_cancelled, sensitivity=sensitivity, aim_error=aim_error):
+        pass
     return results
 
 
-def plot_results(distances, data, results, mode='ttk', log_x=False, log_y=False, show_nr=False):
+def add_cli_arguments(parser, max_distance=True, aim_error_flags=("-a", "--aim-error")):
+    """
+    Add the analysis options shared by the batch command line tools
+
+    :param parser: argparse.ArgumentParser
+    :param max_distance: also add -d/--max-distance, see `get_cli_distances`
+    :param aim_error_flags: option strings of the aim error, for tools that use -a for something else
+    """
+    parser.add_argument("-s", "--spread", nargs=2, type=float, default=(1.0, 1.0),
+                        help="spread in degrees for weapons without a 'spread' entry")
+    parser.add_argument("-c", "--aim-center", default='chest', choices=list(AIM_CENTER_DICT.keys()))
+    if max_distance:
+        parser.add_argument("-d", "--max-distance", type=float, default=100.)
+    parser.add_argument("--hp", type=float, default=DEFAULT_TARGET_HP)
+    parser.add_argument(*aim_error_flags, dest='aim_error', nargs=2, type=float, default=None,
+                        help="(horizontal, vertical) aim jitter standard deviation in meters")
+    parser.add_argument("-t", "--target", default=DEFAULT_HITBOX, choices=list(HITBOXES.keys()))
+
+
+def get_cli_distances(max_distance):
+    """
+    Distance grid of the batch command line tools: 1 m steps from 10 m
+
+    :param max_distance: max distance in meters
+    :return: array of distances
+    """
+    return np.linspace(10, max_distance, int(max_distance))
+
+
+def get_colors(n):
+    """
+    Line colors for n weapons: plotly defaults when they suffice, otherwise evenly spaced hues
+
+    :param n: number of weapons
+    :return: list of color strings
+    """
+    if n <= len(DEFAULT_PLOTLY_COLORS):
+        return DEFAULT_PLOTLY_COLORS[:n]
+    out = []
+    for i in range(n):
+        r, g, b = colorsys.hls_to_rgb(i / n, 0.6, 0.7 if i % 2 == 0 else 0.9)
+        out.append(f"rgb({int(255 * r)}, {int(255 * g)}, {int(255 * b)})")
+    return out
+
+
+def downsample_curve(x, y, max_points):
+    """
+    Reduce a curve to about max_points points for display, keeping every step of step-like curves
+
+    :param x: x values
+    :param y: y values
+    :param max_points: target number of points
+    :return: x, y subsets
+    """
+    if max_points is None or len(x) <= max_points:
+        return x, y
+    idx = np.round(np.linspace(0, len(x) - 1, max_points)).astype(int)
+    steps = np.flatnonzero(np.diff(y) != 0)
+    if len(steps) < max_points:
+        idx = np.union1d(idx, np.concatenate([steps, steps + 1]))
+    return np.asarray(x)[idx], np.asarray(y)[idx]
+
+
+def plot_results(distances, data, results, mode='ttk', log_x=False, log_y=False, show_nr=False, show_hp=None,
+                 render_mode='auto', max_points=None, show_sens=False):
+    """
+    Plot DPS, STK or TTK curves from `analyze` results
+
+    :param show_hp: hp values to overlay, defaults to all hp values in the results
+    :param show_sens: overlay the first-order change in DPS or TTK for SENSITIVITY_SPREAD_STEP more spread
+        on both axes, on a secondary y-axis; needs results computed with `sensitivity=True`
+    :param render_mode: 'svg', 'webgl', or 'auto' to use WebGL above WEBGL_MIN_WEAPONS weapons
+    :param max_points: downsample each curve to about this many points for display
+    """
     fig = go.Figure()
     fig.update_layout(
         width=1100,
@@ -185,65 +563,112 @@ def plot_results(distances, data, results, mode='ttk', log_x=False, log_y=False,
         hovermode='x unified',
         template='plotly_dark',
     )
+    x_range = y_range = None
     if results is not None:
-        dps, stk, ttk, dps_nr, stk_nr, ttk_nr = results
-        guns = list(stk.keys())
+        assert (mode in ('dps', 'stk', 'ttk')), "invalid plot mode"
+        if render_mode == 'auto':
+            render_mode = 'webgl' if len(results.guns) > WEBGL_MIN_WEAPONS else 'svg'
+        scatter = go.Scattergl if render_mode == 'webgl' else go.Scatter
         fig.data = []
-        y_min = 1e99
-        y_max = -1e99
-        for i, gun in enumerate(guns):
-            assert (mode in ('dps', 'stk', 'ttk')), "invalid plot mode"
-            y = eval(mode)[gun]
-            y_nr = eval(mode + '_nr')[gun]
-            if min(y) < y_min:
-                y_min = min(y)
-            if max(y) > y_max:
-                y_max = max(y)
-            color = DEFAULT_PLOTLY_COLORS[i]
+        levels = [(h, k) for k, h in enumerate(results.hp) if show_hp is None or h in show_hp]
+        if len(levels) > 0:
+            shown = [k for _, k in levels]
+            y_all = np.concatenate([results.metric(mode)[..., shown], results.metric(mode + '_nr')[..., shown]])
+            x_range = (np.min(distances), np.max(distances))
+            y_range = (np.nanmin(y_all), np.nanmax(y_all))     # partial results are NaN where not computed yet
+        colors = get_colors(len(results.guns))
+        traces = []
+        for i, gun in enumerate(results.guns):
+            color = colors[i]
             if mode == 'stk':
                 shape = 'hv'
             else:
                 shape = 'linear'
-            traces = [
-                go.Scatter(
-                    mode='lines',
-                    x=distances,
-                    y=y,
-                    name=gun,
-                    line=dict(color=color, shape=shape)
-                ),
-                go.Scatter(
-                    mode='lines',
-                    x=distances,
-                    y=y_nr,
-                    name=gun + ' (no recoil)',
-                    line=dict(color=color, dash='dash', shape=shape),
-                )
-            ]
-            mag_cap = np.argmax(np.asarray(stk[gun]) > data[i]['mag_size']) - 1
-            if mag_cap > 0:
-                traces.append(
-                    go.Scatter(
-                        mode='markers',
-                        x=[distances[mag_cap]],
-                        y=[y[mag_cap]],
-                        name=gun + ' mag cap',
-                        marker=dict(color=color, size=15, symbol='star'),
-                        showlegend=False,
+            for n, (level, k) in enumerate(levels):
+                y = results.metric(mode)[i, :, k]
+                y_nr = results.metric(mode + '_nr')[i, :, k]
+                stk_level = results.metric('stk')[i, :, k]
+                name = gun if len(results.hp) == 1 else f"{gun} ({level:.0f} HP)"
+                opacity = 1 - 0.6 * n / max(1, len(levels) - 1)
+                x_plot, y_plot = downsample_curve(distances, y, max_points)
+                x_plot_nr, y_plot_nr = downsample_curve(distances, y_nr, max_points)
+                traces.extend([
+                    scatter(
+                        mode='lines',
+                        x=x_plot,
+                        y=y_plot,
+                        name=name,
+                        opacity=opacity,
+                        line=dict(color=color, shape=shape)
+                    ),
+                    scatter(
+                        mode='lines',
+                        x=x_plot_nr,
+                        y=y_plot_nr,
+                        name=name + ' (no recoil)',
+                        opacity=opacity,
+                        line=dict(color=color, dash='dash', shape=shape),
                     )
-                )
-            fig.add_traces(traces)
-    update_fig(fig, mode=mode, log_x=log_x, log_y=log_y, show_nr=show_nr)
+                ])
+                if show_sens and results.sensitivity and mode != 'stk':
+                    y_sens = SENSITIVITY_SPREAD_STEP * (
+                        results.metric(f'd{mode}_dx')[i, :, k] + results.metric(f'd{mode}_dy')[i, :, k])
+                    x_plot_sens, y_plot_sens = downsample_curve(distances, y_sens, max_points)
+                    traces.append(
+                        scatter(
+                            mode='lines',
+                            x=x_plot_sens,
+                            y=y_plot_sens,
+                            name=name + ' (sensitivity)',
+                            opacity=opacity,
+                            line=dict(color=color, dash='dot'),
+                            yaxis='y2',
+                        )
+                    )
+                mag_cap = np.argmax(stk_level > data[i]['mag_size']) - 1
+                if mag_cap > 0:
+                    traces.append(
+                        scatter(
+                            mode='markers',
+                            x=[distances[mag_cap]],
+                            y=[y[mag_cap]],
+                            name=name + ' mag cap',
+                            opacity=opacity,
+                            marker=dict(color=color, size=15, symbol='star'),
+                            showlegend=False,
+                        )
+                    )
+        fig.add_traces(traces)
+    update_fig(fig, mode=mode, log_x=log_x, log_y=log_y, show_nr=show_nr, x_range=x_range, y_range=y_range)
+    if results is not None and show_sens and results.sensitivity and mode != 'stk':
+        unit = " [s]" if mode == 'ttk' else ""
+        # Assigned after update_fig, which would otherwise apply the main axis settings to it
+        fig.layout.yaxis2 = dict(
+            title_text=f"Change in {mode.upper()} per +{SENSITIVITY_SPREAD_STEP}\u00b0 spread{unit}",
+            overlaying='y',
+            side='right',
+            showgrid=False,
+            type='linear',
+            autorange=True,
+        )
     return fig
 
 
-def update_fig(fig, mode='ttk', log_x=False, log_y=False, show_nr=False):
+def update_fig(fig, mode='ttk', log_x=False, log_y=False, show_nr=False, x_range=None, y_range=None):
+    """
+    Set axes and no-recoil trace visibility
+
+    :param x_range: (min, max) of the plotted data, scanned from the traces if not given
+    :param y_range: (min, max) of the plotted data, scanned from the traces if not given
+    """
     fig_data = fig['data']
     if len(fig_data) > 0:
-        x_min = min([min(trace['x']) for trace in fig_data])
-        x_max = max([max(trace['x']) for trace in fig_data])
-        y_min = min([min(trace['y']) for trace in fig_data])
-        y_max = max([max(trace['y']) for trace in fig_data])
+        if x_range is None:
+            x_range = (min([min(trace['x']) for trace in fig_data]), max([max(trace['x']) for trace in fig_data]))
+        if y_range is None:
+            y_range = (min([min(trace['y']) for trace in fig_data]), max([max(trace['y']) for trace in fig_data]))
+        x_min, x_max = x_range
+        y_min, y_max = y_range
         if log_x:
             if x_max >= 100:
                 fig.update_xaxes(
@@ -292,29 +717,106 @@ def tick_format(value):
         return '${0:.1f}$'.format(value)
 
 
-def plot_beam_profile(weapon_data, distance, center, zoom=1, fov=80, target=TARGET):
+def create_beam_profile(beam_box, x_pixels, y_pixels, gaussian_scale=BEAM_GAUSSIAN_SCALE):
+    """
+    Gaussian beam profile on a window of pixels, scaled to a peak of 1
+
+    :param beam_box: (x0, x1, y0, y1) in pixels
+    :param x_pixels: x coordinates of the window columns in pixels
+    :param y_pixels: y coordinates of the window rows in pixels
+    :return: float32 array (y, x), ready for `imshow`
+    """
+    x0, x1, y0, y1 = beam_box
+    profile_x = np.exp(-((x_pixels - (x0 + x1) / 2) / ((x1 - x0) / gaussian_scale)) ** 2).astype(np.float32)
+    profile_y = np.exp(-((y_pixels - (y0 + y1) / 2) / ((y1 - y0) / gaussian_scale)) ** 2).astype(np.float32)
+    return np.outer(profile_y, profile_x)
+
+
+def get_frame_window(beam_box, view_box, im_shape, step=1):
+    """
+    Pixel range drawn in one beam image: the hitbox and the beam out to 3 sigma, where it has faded
+    to black, cropped to the view
+
+    :param beam_box: (x0, x1, y0, y1) in pixels
+    :param view_box: (x0, x1, y0, y1) visible area in pixels
+    :param im_shape: hitbox image shape
+    :param step: the range is extended to a whole number of blocks of this many pixels
+    :return: (x0, x1, y0, y1) integer pixel range, end exclusive
+    """
+    window = []
+    for lo, hi, view_lo, view_hi, n in ((beam_box[0], beam_box[1], view_box[0], view_box[1], im_shape[0]),
+                                        (beam_box[2], beam_box[3], view_box[2], view_box[3], im_shape[1])):
+        beam_lo, beam_hi = (3 * lo - hi) / 2, (3 * hi - lo) / 2
+        start = max(min(0, int(np.floor(beam_lo))), int(np.floor(view_lo)))
+        stop = min(max(n, int(np.ceil(beam_hi))), int(np.ceil(view_hi)) + 1)
+        window.extend([start, start + step * max(int(np.ceil((stop - start) / step)), 1)])
+    return tuple(window)
+
+
+def plot_beam_flipbook(weapon_data, distances, center, zoom=1, fov=80, target=TARGET, aim_error=None):
+    """
+    Sprite sheet of the beam and hit-box view at several distances, frames stacked top to bottom
+
+    Each frame only draws the part of the hitbox and of its beam inside its own view, averaged
+    down to about one pixel per screen pixel, so memory does not grow with the beam size, and the
+    sheet costs one render instead of one per distance.
+
+    :param weapon_data: weapon data with a 'spread' entry
+    :param distances: frame distances in meters
+    :param center: aim center offset
+    :param zoom: scope zoom
+    :param fov: field of view in degrees
+    :param target: name of a registered hitbox model or hitbox array
+    :param aim_error: optional (horizontal, vertical) aim jitter standard deviation in meters
+    :return: matplotlib Figure
+    """
+    distances = np.atleast_1d(np.asarray(distances, dtype=float))
     fov_rad = fov * np.pi / 180.
     screen_width = 10
-    screen_aspect = 16 / 9.
-    center_pix = get_aim_center(center, target=target)
+    target, _, im_scale, _ = resolve_target(target)
+    center_pix = get_aim_center(center, target=target, im_scale=im_scale)
     spread = weapon_data['spread']
-    beam_box = get_beam_box(center_pix, spread, distance)
-    target, center_pix, beam_box = resize_target(target, center_pix, beam_box)
-    beam_profile = create_beam_profile(target.shape, beam_box)
-    fig, ax = plt.subplots(1, 1, figsize=(screen_width, screen_width / screen_aspect))
-    ax.set_position([0, 0, 1, 1])
-    ax.imshow(target.T, origin='lower', cmap='gray')
-    ax.imshow(beam_profile.T, origin='lower', cmap='copper', alpha=0.8)
-    ax.plot(beam_box[:2], [center_pix[1], center_pix[1]], color='r')
-    ax.plot([center_pix[0], center_pix[0]], beam_box[2:], color='r')
-    ax.set_aspect('equal')
-    ax.set_xlim(
-        center_pix[0] - 0.5 * fov_rad * distance * IM_SCALE / zoom,
-        center_pix[0] + 0.5 * fov_rad * distance * IM_SCALE / zoom
-    )
-    ax.set_ylim(
-        center_pix[1] - 0.5 * fov_rad * distance * IM_SCALE / screen_aspect / zoom,
-        center_pix[1] + 0.5 * fov_rad * distance * IM_SCALE / screen_aspect / zoom
-    )
-    plt.axis('off')
+    aim_error = get_aim_error(aim_error)
+    # Fixed color scales, so cropping a frame does not change its colors
+    target_range = dict(vmin=target.min(), vmax=target.max())
+    # Object-oriented figure with its own Agg canvas, so concurrent renders in threads don't share pyplot state
+    n = len(distances)
+    fig = Figure(figsize=(screen_width, n * screen_width / SCREEN_ASPECT), facecolor='black')
+    FigureCanvasAgg(fig)
+    for i, distance in enumerate(distances):
+        beam_box = get_beam_box(center_pix, spread, distance, im_scale=im_scale, aim_error=aim_error)
+        half_width = 0.5 * fov_rad * distance * im_scale / zoom
+        view_box = (
+            center_pix[0] - half_width,
+            center_pix[0] + half_width,
+            center_pix[1] - half_width / SCREEN_ASPECT,
+            center_pix[1] + half_width / SCREEN_ASPECT,
+        )
+        # Hitbox pixels per screen pixel; finer detail would only be averaged away when drawing
+        step = max(int(2 * half_width / (screen_width * fig.dpi)), 1)
+        x0, x1, y0, y1 = get_frame_window(beam_box, view_box, target.shape, step=step)
+        frame = np.zeros((x1 - x0, y1 - y0), dtype=target.dtype)
+        tx0, tx1, ty0, ty1 = max(x0, 0), min(x1, target.shape[0]), max(y0, 0), min(y1, target.shape[1])
+        if tx0 < tx1 and ty0 < ty1:
+            frame[tx0 - x0:tx1 - x0, ty0 - y0:ty1 - y0] = target[tx0:tx1, ty0:ty1]
+        if step > 1:
+            frame = frame.reshape(frame.shape[0] // step, step, -1, step).mean(axis=(1, 3), dtype=np.float32)
+        block_centers_x = np.arange(x0, x1, step) + (step - 1) / 2
+        block_centers_y = np.arange(y0, y1, step) + (step - 1) / 2
+        extent = (x0 - 0.5, x1 - 0.5, y0 - 0.5, y1 - 0.5)
+        ax = fig.add_axes([0, 1 - (i + 1) / n, 1, 1 / n])
+        ax.set_facecolor('black')
+        ax.imshow(frame.T, origin='lower', cmap='gray', extent=extent, **target_range)
+        ax.imshow(create_beam_profile(beam_box, block_centers_x, block_centers_y), origin='lower', cmap='copper',
+                  alpha=0.8, extent=extent, vmin=0, vmax=1)
+        ax.plot(beam_box[:2], [center_pix[1], center_pix[1]], color='r')
+        ax.plot([center_pix[0], center_pix[0]], beam_box[2:], color='r')
+        ax.set_aspect('equal')
+        ax.set_xlim(*view_box[:2])
+        ax.set_ylim(*view_box[2:])
+        ax.axis('off')
     return fig
+
+
+def plot_beam_profile(weapon_data, distance, center, zoom=1, fov=80, target=TARGET, aim_error=None):
+    return plot_beam_flipbook(weapon_data, [distance], center, zoom=zoom, fov=fov, target=target, aim_error=aim_error)